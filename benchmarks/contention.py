@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""Measure commit throughput of concurrent sessions
+
+Starts --workers processes with their own database connection, each
+committing --commits changes to zones picked from the first --hot zones
+of the synthetic schema from suite.py. Few hot zones means many commits
+to the same zone at the same time. Prints commits per second, retries
+and whether every commit got its own serial.
+
+    benchmarks/contention.py --dbname bench --workers 8 --hot 4
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+
+import suite
+from suite import pdns, connect
+
+
+def serials(conn, zones):
+    db = conn.cursor()
+    db.execute("SELECT d.name, split_part(r.content, ' ', 3)::bigint FROM records r "
+               "JOIN domains d ON d.id = r.domain_id WHERE r.type = 'SOA' AND d.name = ANY(%s)", (zones,))
+    result = dict(db.fetchall())
+    conn.commit()
+    return result
+
+
+def worker(options, number, queue):
+    pdns.dbconn.conn = connect(options)
+    pdns.NOTIFY_MODE = 'native'
+    pdns.SLAVES = []
+    rnd = random.Random(options.seed + number)
+    commander = pdns.DNSCommander()
+    commits = {}
+    latencies = []
+    with redirect_stdout(io.StringIO()):
+        for i in range(options.commits):
+            zone = suite.zone_name(rnd.randrange(options.hot))
+            commander.do_domain(zone)
+            for j in range(options.changes):
+                commander.do_add('bench-%d-%d-%d TXT "contention"' % (number, i, j))
+            start = time.perf_counter()
+            commander.do_commit('')
+            latencies.append(time.perf_counter() - start)
+            commits[zone] = commits.get(zone, 0) + 1
+    queue.put((commits, latencies, pdns.stats.retries))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pdns.py commit contention benchmark")
+    parser.add_argument('--host', default=os.environ.get('PGHOST', '127.0.0.1'))
+    parser.add_argument('--port', default=os.environ.get('PGPORT', '5432'))
+    parser.add_argument('--dbname', default=os.environ.get('PGDATABASE', 'postgres'))
+    parser.add_argument('--user', default=os.environ.get('PGUSER', 'postgres'))
+    parser.add_argument('--password', default=os.environ.get('PGPASSWORD', ''))
+    parser.add_argument('--schema', default='pdnscmd_contention')
+    parser.add_argument('--zones', type=int, default=100)
+    parser.add_argument('--hot', type=int, default=4, help="zones the workers commit to")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--commits', type=int, default=50, help="commits per worker")
+    parser.add_argument('--changes', type=int, default=5, help="records per commit")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--keep', action='store_true', help="do not drop the schema")
+    options = parser.parse_args()
+    options.hot = min(options.hot, options.zones)
+    # suite.generate parameters
+    options.records, options.adds, options.reverse_zones = 10, 0, 1
+
+    conn = connect(options)
+    suite.generate(conn, options)
+    hot = [suite.zone_name(i) for i in range(options.hot)]
+    before = serials(conn, hot)
+
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(options, i, queue)) for i in range(options.workers)]
+    start = time.perf_counter()
+    for p in processes:
+        p.start()
+    results = [queue.get() for p in processes]
+    elapsed = time.perf_counter() - start
+    for p in processes:
+        p.join()
+
+    commits = {}
+    latencies = []
+    for zone_commits, worker_latencies, retries in results:
+        for zone, n in zone_commits.items():
+            commits[zone] = commits.get(zone, 0) + n
+        latencies += worker_latencies
+    after = serials(conn, hot)
+    today = int(datetime.now().strftime('%Y%m%d01'))
+    lost = dict([(zone, max(before[zone] + 1, today) + commits[zone] - 1 - after[zone])
+                 for zone in commits if max(before[zone] + 1, today) + commits[zone] - 1 != after[zone]])
+    latencies.sort()
+
+    if not options.keep:
+        conn.cursor().execute("DROP SCHEMA %s CASCADE" % options.schema)
+        conn.commit()
+
+    print(json.dumps({
+        'version': suite.version(),
+        'parameters': dict([(k, v) for k, v in vars(options).items() if k != 'password']),
+        'elapsed': round(elapsed, 3),
+        'commits': sum(commits.values()),
+        'commits_per_second': round(sum(commits.values()) / elapsed, 1),
+        'retries': sum([x[2] for x in results]),
+        'commit_p50': round(latencies[len(latencies) // 2], 6),
+        'commit_p95': round(latencies[int(len(latencies) * 0.95)], 6),
+        'lost_serial_updates': lost,
+    }, indent=2))
+    return 1 if lost else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""Measure memory of loaded zone records
+
+Builds the record stores of pdns.py from generated rows of a reverse
+zone 10.in-addr.arpa, the same (name, type, ttl, prio, content) tuples the backends
+return, and reports bytes per record measured with tracemalloc. No
+database is needed. The dicts row is how records were kept before
+RecordRow, for comparison.
+
+    benchmarks/memory.py --records 500000
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+from suite import pdns, address, version
+
+ZONE = '10.in-addr.arpa'
+
+
+def rows(count):
+    for n in range(count):
+        ip = address(n)
+        # rows of the backend, strings are fresh objects like from the driver
+        yield ('%s' % pdns.reverse_name(ip), ''.join(['P', 'TR']), 3600, None,
+               'host-%s.example.com.' % ip.replace('.', '-'))
+
+
+def dicts(source):
+    names = {}
+    for row in source:
+        names.setdefault(row[0], []).append({
+            'key': row[0],
+            'type': row[1] or '-',
+            'ttl': row[2] or '-',
+            'priority': '-' if row[3] is None or row[3] == '' else '%s' % (row[3],),
+            'value': row[4] or '-',
+        })
+    return names
+
+
+def measure(build, count):
+    """Memory traced on one build, time of a second untraced one"""
+    gc.collect()
+    tracemalloc.start()
+    store = build(rows(count))
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del store
+    gc.collect()
+    start = time.perf_counter()
+    store = build(rows(count))
+    elapsed = time.perf_counter() - start
+    result = {'bytes_per_record': round(size / count, 1), 'total_mb': round(size / 2 ** 20, 1),
+              'peak_mb': round(peak / 2 ** 20, 1), 'build_seconds': round(elapsed, 3)}
+    if not isinstance(store, dict):
+        names = [pdns.reverse_name(address(n)) for n in range(0, count, max(1, count // 1000))]
+        start = time.perf_counter()
+        for name in names:
+            store.get(name, 'PTR')
+            list(islice_prefix(store, name[:4]))
+        result['lookup_us'] = round((time.perf_counter() - start) / len(names) * 1e6, 1)
+    del store
+    return result
+
+
+def islice_prefix(store, prefix, limit=20):
+    for i, name in enumerate(store.names_with_prefix(prefix)):
+        if i >= limit:
+            break
+        yield name
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pdns.py record store memory benchmark")
+    parser.add_argument('--records', type=int, default=500000)
+    options = parser.parse_args()
+
+    print(json.dumps({
+        'version': version(),
+        'python': sys.version.split()[0],
+        'records': options.records,
+        'results': {
+            'dicts': measure(dicts, options.records),
+            'RecordStore': measure(lambda x: pdns.RecordStore(pdns.RecordRow.from_row(r) for r in x),
+                                   options.records),
+            'ColumnarRecordStore': measure(lambda x: pdns.ColumnarRecordStore(x, ZONE), options.records),
+        },
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
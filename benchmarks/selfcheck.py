@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""Check notify and the API backend against local stubs, no PowerDNS or database needed
+
+Native notify is sent to a UDP listener on 127.0.0.1 that checks the
+opcode, qname and qtype of the query and answers it. The API backend
+commits to an HTTP stub of the zones endpoints, which checks the PATCH
+body. Prints one line per check and exits with 1 if any failed.
+
+    benchmarks/selfcheck.py
+"""
+
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('CONFIG_FILE', os.path.join(ROOT, 'pdnscmd.conf.sample'))
+
+import pdns
+
+
+def qname(packet):
+    """Decode the question name of a DNS packet, return (name, offset after it)"""
+    labels = []
+    i = 12
+    while packet[i]:
+        labels.append(packet[i + 1:i + 1 + packet[i]].decode('ascii'))
+        i += 1 + packet[i]
+    return '.'.join(labels), i + 1
+
+
+def notify_listener(received):
+    """UDP socket answering NOTIFY queries, appends (opcode, qname, qtype) to received"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+
+    def serve():
+        while True:
+            data, address = sock.recvfrom(512)
+            qid, flags = struct.unpack('!HH', data[:4])
+            name, end = qname(data)
+            qtype, = struct.unpack('!H', data[end:end + 2])
+            received.append(((flags >> 11) & 0xf, name, qtype))
+            sock.sendto(struct.pack('!HH', qid, flags | 0x8000) + data[4:], address)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return sock.getsockname()[1]
+
+
+def check_native_notify():
+    received = []
+    port = notify_listener(received)
+    results = pdns.NotifyDispatcher(mode='native', targets=['127.0.0.1:%d' % port], timeout=2).notify(
+        ['example.com', 'example.net'])
+    assert all(x.ok for x in results), [str(x) for x in results]
+    assert sorted(received) == [(4, 'example.com', 6), (4, 'example.net', 6)], received
+
+
+class ApiStub(BaseHTTPRequestHandler):
+    """Zones endpoints of the PowerDNS API serving and patching ZONE"""
+
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def reply(self, code, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append(('GET', self.path, None))
+        if '/zones?zone=' in self.path:
+            return self.reply(200, [ApiStub.zone] if self.path.endswith('=' + ApiStub.zone['name']) else [])
+        self.reply(200, ApiStub.zone)
+
+    def do_PATCH(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.requests.append(('PATCH', self.path, body))
+        for rrset in body['rrsets']:
+            ApiStub.zone['rrsets'] = [x for x in ApiStub.zone['rrsets']
+                                      if (x['name'], x['type']) != (rrset['name'], rrset['type'])]
+            if rrset['changetype'] == 'REPLACE':
+                ApiStub.zone['rrsets'].append(dict([(k, rrset[k]) for k in ('name', 'type', 'ttl', 'records')]))
+        self.reply(204)
+
+    def do_PUT(self):
+        self.requests.append(('PUT', self.path, None))
+        self.reply(200, {'result': 'ok'})
+
+
+def check_api_patch():
+    ApiStub.zone = {'id': 'example.com.', 'name': 'example.com.', 'kind': 'Master', 'rrsets': [
+        {'name': 'www.example.com.', 'type': 'TXT', 'ttl': 300, 'records': [{'content': '"one"', 'disabled': False}]}]}
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ApiStub)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    pdns.current_backend = pdns.ApiBackend(url='http://127.0.0.1:%d' % server.server_address[1], key='secret')
+    pdns.NOTIFY_MODE = 'api'
+    try:
+        commander = pdns.DNSCommander()
+        commander.do_domain('example.com')
+        commander.current_domain.records()
+        # changed by someone else after the zone was loaded
+        ApiStub.zone['rrsets'][0]['records'].append({'content': '"two"', 'disabled': False})
+        commander.do_add('www TXT "three"')
+        commander.do_commit('')
+    finally:
+        server.shutdown()
+        server.server_close()
+        pdns.current_backend = None
+    patches = [x for x in ApiStub.requests if x[0] == 'PATCH']
+    assert len(patches) == 1, patches
+    assert patches[0][1].endswith('/zones/example.com.'), patches[0][1]
+    rrsets = patches[0][2]['rrsets']
+    assert len(rrsets) == 1 and rrsets[0]['changetype'] == 'REPLACE', rrsets
+    assert [x['content'] for x in rrsets[0]['records']] == ['"one"', '"two"', '"three"'], rrsets
+    assert ('PUT', '/api/v1/servers/localhost/zones/example.com./notify', None) in ApiStub.requests, ApiStub.requests
+
+
+CHECKS = [
+    check_native_notify,
+    check_api_patch,
+]
+
+
+def main():
+    failed = 0
+    for check in CHECKS:
+        try:
+            check()
+            print("ok      %s" % check.__name__)
+        except AssertionError as e:
+            failed += 1
+            print("FAILED  %s: %s" % (check.__name__, e))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
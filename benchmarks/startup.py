@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""Measure cold start time of pdns.py
+
+Every case runs pdns.py in a fresh interpreter, none of them needs a
+database connection. Results are printed as JSON, times in seconds.
+
+    benchmarks/startup.py --runs 20
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from statistics import median
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PDNS = os.path.join(ROOT, 'pdns.py')
+
+CASES = {
+    'import': (['-c', 'import pdns'], ''),
+    'help': ([PDNS, '--help'], ''),
+    'shell': ([PDNS], ''),
+    'batch': ([PDNS, '--batch', '-'], '# nothing to do\n'),
+}
+
+
+def measure(args, stdin, runs, env):
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, input=stdin, env=env, cwd=ROOT,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       universal_newlines=True, check=True)
+        times.append(time.perf_counter() - start)
+    return {'min': round(min(times), 4), 'median': round(median(times), 4), 'max': round(max(times), 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pdns.py startup benchmark")
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--config', default=os.path.join(ROOT, 'pdnscmd.conf.sample'),
+                        help="config file to start with")
+    parser.add_argument('cases', nargs='*', default=sorted(CASES))
+    options = parser.parse_args()
+
+    env = dict(os.environ, CONFIG_FILE=options.config)
+    baseline = measure(['-c', 'pass'], '', options.runs, env)
+    results = {'python': sys.version.split()[0], 'runs': options.runs, 'interpreter': baseline, 'cases': {}}
+    for case in options.cases:
+        args, stdin = CASES[case]
+        results['cases'][case] = measure(args, stdin, options.runs, env)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""Benchmark hot paths of pdns.py against a synthetic PowerDNS database
+
+Creates the gpgsql tables documented in pdns.Domain in their own schema
+of a local PostgreSQL database, fills them with generated forward and
+reverse zones and times shell commands on them. Results are printed as
+JSON so runs of different versions can be compared.
+
+    benchmarks/suite.py --dbname bench --zones 1000 --records 200 --output result.json
+
+Addresses are numbered from 10.0.0.0 in blocks of records + adds per
+zone, the first --reverse-zones /24 networks have reverse zones. Adds
+are timed on the first zone, its block must be covered by reverse zones.
+
+The schema is dropped afterwards unless --keep is given, --reuse skips
+generating data when the schema is already there.
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from contextlib import redirect_stdout
+from statistics import median
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('CONFIG_FILE', os.path.join(ROOT, 'pdnscmd.conf.sample'))
+
+import pdns
+
+SCHEMA = """
+CREATE TABLE domains (
+  id SERIAL PRIMARY KEY,
+  name VARCHAR(255) NOT NULL,
+  master VARCHAR(128) DEFAULT NULL,
+  last_check INT DEFAULT NULL,
+  type VARCHAR(6) NOT NULL,
+  notified_serial INT DEFAULT NULL,
+  account VARCHAR(40) DEFAULT NULL
+);
+CREATE UNIQUE INDEX name_index ON domains(name);
+
+CREATE TABLE records (
+  id BIGSERIAL PRIMARY KEY,
+  domain_id INT DEFAULT NULL REFERENCES domains(id) ON DELETE CASCADE,
+  name VARCHAR(255) DEFAULT NULL,
+  type VARCHAR(10) DEFAULT NULL,
+  content VARCHAR(65535) DEFAULT NULL,
+  ttl INT DEFAULT NULL,
+  prio INT DEFAULT NULL,
+  change_date INT DEFAULT NULL,
+  disabled BOOL DEFAULT 'f',
+  ordername VARCHAR(255),
+  auth BOOL DEFAULT 't'
+);
+CREATE INDEX rec_name_index ON records(name);
+CREATE INDEX nametype_index ON records(name,type);
+CREATE INDEX domain_id ON records(domain_id);
+CREATE INDEX recordorder ON records (domain_id, ordername text_pattern_ops);
+
+CREATE TABLE domainmetadata (
+  id SERIAL PRIMARY KEY,
+  domain_id INT REFERENCES domains(id) ON DELETE CASCADE,
+  kind VARCHAR(32),
+  content TEXT
+);
+CREATE INDEX domainidmetaindex ON domainmetadata(domain_id);
+
+CREATE TABLE cryptokeys (
+  id SERIAL PRIMARY KEY,
+  domain_id INT REFERENCES domains(id) ON DELETE CASCADE,
+  flags INT NOT NULL,
+  active BOOL,
+  published BOOL DEFAULT TRUE,
+  content TEXT
+);
+CREATE INDEX domainidindex ON cryptokeys(domain_id);
+"""
+
+
+def connect(options):
+    """Connection to the benchmark schema, psycopg2 is only imported here"""
+    import psycopg2
+    return psycopg2.connect(host=options.host, port=options.port, dbname=options.dbname,
+                            user=options.user, password=options.password,
+                            options='-c search_path=%s' % options.schema,
+                            cursor_factory=pdns.instrumented_cursor())
+
+
+def zone_name(i):
+    return 'zone%06d.bench.test' % i
+
+
+def address(n):
+    """n:th address of 10.0.0.0/8, reverse zone n >> 8 is its /24"""
+    return '10.%d.%d.%d' % ((n >> 16) % 256, (n >> 8) % 256, n % 256)
+
+
+def reverse_zone(i):
+    return '%d.%d.10.in-addr.arpa' % (i % 256, (i >> 8) % 256)
+
+
+def generate(conn, options):
+    db = conn.cursor()
+    db.execute("DROP SCHEMA IF EXISTS %s CASCADE" % options.schema)
+    db.execute("CREATE SCHEMA %s" % options.schema)
+    db.execute("SET search_path TO %s" % options.schema)
+    db.execute(SCHEMA)
+
+    soa = '%s %s 2024010101 3600 900 1209600 86400' % (pdns.MASTER_DNS, pdns.ADMIN_CONTACT)
+    reverse_zones = [reverse_zone(i) for i in range(options.reverse_zones)]
+    stride = options.records + options.adds
+    domains = [(zone_name(i), 'MASTER') for i in range(options.zones)] + [(x, 'MASTER') for x in reverse_zones]
+    db.copy_expert("COPY domains (name, type) FROM STDIN", pdns.CopyStream(domains))
+    db.execute("SELECT name, id FROM domains")
+    ids = dict(db.fetchall())
+
+    def rows():
+        for name, _ in domains:
+            yield (ids[name], name, 'SOA', soa, 3600, None)
+            for ns in [pdns.MASTER_DNS] + pdns.SLAVES:
+                yield (ids[name], name, 'NS', ns, 3600, None)
+        for i in range(options.zones):
+            name = zone_name(i)
+            for host in range(options.records):
+                ip = address(i * stride + host)
+                yield (ids[name], 'host%d.%s' % (host, name), 'A', ip, 3600, None)
+                reverse = pdns.reverse_name(ip)
+                zone = reverse.split('.', 1)[1]
+                if zone in ids:
+                    yield (ids[zone], reverse, 'PTR', 'host%d.%s.' % (host, name), 3600, None)
+
+    db.copy_expert("COPY records (domain_id, name, type, content, ttl, prio) FROM STDIN", pdns.CopyStream(rows()))
+    db.execute("ANALYZE")
+    conn.commit()
+
+
+def timed(results, name, func, *args):
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        value = func(*args)
+    results.setdefault(name, []).append(time.perf_counter() - start)
+    return value
+
+
+def summary(times):
+    times = sorted(times)
+    return {
+        'count': len(times),
+        'total': round(sum(times), 6),
+        'mean': round(sum(times) / len(times), 6),
+        'p50': round(median(times), 6),
+        'p95': round(times[int(len(times) * 0.95)], 6),
+        'max': round(times[-1], 6),
+    }
+
+
+def run(options):
+    results = {}
+    rnd = random.Random(options.seed)
+    zones = [zone_name(i) for i in rnd.sample(range(options.zones), min(options.samples, options.zones))]
+    stride = options.records + options.adds
+
+    for zone in zones:
+        commander = pdns.DNSCommander()
+        timed(results, 'do_domain', commander.do_domain, zone)
+
+    # zone 0 has its addresses in the first reverse zones
+    commander = pdns.DNSCommander()
+    commander.do_domain(zone_name(0))
+    for host in range(options.adds):
+        ip = address(options.records + host)
+        timed(results, 'do_add_with_reverse', commander.do_add, 'new%d A %s' % (host, ip))
+    timed(results, 'do_commit', commander.do_commit, '')
+
+    for zone in zones:
+        commander.do_domain(zone)
+        timed(results, 'list', commander.do_list, '')
+        timed(results, 'list_filter', commander.do_list, 'host1')
+
+    commander = pdns.DNSCommander()
+    for i in range(options.samples):
+        prefix = zone_name(rnd.randrange(options.zones))[:rnd.randrange(4, 14)]
+        timed(results, 'complete_domain', commander.complete_domain, prefix, 'domain ' + prefix, 0, 7 + len(prefix))
+
+    timed(results, 'audit', commander.do_audit, '')
+
+    commander.do_domain(zones[0])
+    for host in range(min(options.samples, options.records)):
+        timed(results, 'deleteall', commander.do_deleteall, 'host%d' % host)
+    timed(results, 'deleteall_commit', commander.do_commit, '')
+    return dict([(k, summary(v)) for k, v in sorted(results.items())])
+
+
+def version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pdns.py benchmark suite")
+    parser.add_argument('--host', default=os.environ.get('PGHOST', '127.0.0.1'))
+    parser.add_argument('--port', default=os.environ.get('PGPORT', '5432'))
+    parser.add_argument('--dbname', default=os.environ.get('PGDATABASE', 'postgres'))
+    parser.add_argument('--user', default=os.environ.get('PGUSER', 'postgres'))
+    parser.add_argument('--password', default=os.environ.get('PGPASSWORD', ''))
+    parser.add_argument('--schema', default='pdnscmd_bench')
+    parser.add_argument('--zones', type=int, default=1000)
+    parser.add_argument('--records', type=int, default=100, help="A records per zone")
+    parser.add_argument('--reverse-zones', type=int, default=256)
+    parser.add_argument('--samples', type=int, default=50, help="repetitions of each operation")
+    parser.add_argument('--adds', type=int, default=1000, help="records added before do_commit")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--reuse', action='store_true', help="use data generated by an earlier run")
+    parser.add_argument('--keep', action='store_true', help="do not drop the schema")
+    parser.add_argument('--output', help="write JSON here instead of stdout")
+    options = parser.parse_args()
+    if options.records + options.adds > options.reverse_zones * 256:
+        parser.error("--reverse-zones too small for --records + --adds")
+
+    conn = connect(options)
+    pdns.dbconn.conn = conn
+    pdns.NOTIFY_MODE = 'native'
+    pdns.SLAVES = []
+
+    generate_time = None
+    if not options.reuse:
+        start = time.perf_counter()
+        generate(conn, options)
+        generate_time = round(time.perf_counter() - start, 3)
+
+    result = {
+        'version': version(),
+        'python': sys.version.split()[0],
+        'parameters': dict([(k, v) for k, v in vars(options).items() if k not in ['password', 'output']]),
+        'generate': generate_time,
+        'results': run(options),
+    }
+    if not options.keep:
+        conn.rollback()
+        conn.cursor().execute("DROP SCHEMA %s CASCADE" % options.schema)
+        conn.commit()
+
+    output = json.dumps(result, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,14 +2,31 @@
 # encoding: utf-8
 
 import cmd
+import copy
 import sys
 import os
-import psycopg2
 from datetime import datetime
+from bisect import bisect_left
+from itertools import islice, chain
+from array import array
+import heapq
 import configparser
-from ipaddress import IPv6Address, IPv6Network, IPv4Address, IPv4Network, AddressValueError
+import argparse
+import json
+from contextlib import redirect_stdout, contextmanager
+from ipaddress import IPv6Address, IPv6Network, IPv4Address, IPv4Network, AddressValueError, ip_address
 import subprocess
-import requests
+import socket
+import struct
+import random
+import time
+import re
+import threading
+import weakref
+import hashlib
+import base64
+import tempfile
+from collections import OrderedDict
 
 import logging
 logger = logging.getLogger()
@@ -48,25 +65,689 @@ except configparser.NoOptionError:
 try:
     password = config.get('postgres', 'password')
 except configparser.NoOptionError:
+    # Read from PowerDNS config when connecting
     password = None
-    f = open("/etc/powerdns/pdns.d/pdns.local.gpgsql", 'r')
-    for line in f.readlines():
-        if line.startswith('gpgsql-password='):
-            password = line.split('=', 1)[1]
-    f.close()
 
-    if not password:
-        print("Cannot find postgres password")
-        sys.exit(1)
+try:
+    BACKEND = config.get('global', 'backend')
+except configparser.NoOptionError:
+    BACKEND = 'gpgsql'
+try:
+    API_URL = config.get('api', 'url')
+except (configparser.NoSectionError, configparser.NoOptionError):
+    API_URL = 'http://127.0.0.1:8081'
+try:
+    API_KEY = config.get('api', 'key')
+except (configparser.NoSectionError, configparser.NoOptionError):
+    API_KEY = ''
+try:
+    API_SERVER_ID = config.get('api', 'server_id')
+except (configparser.NoSectionError, configparser.NoOptionError):
+    API_SERVER_ID = 'localhost'
+try:
+    API_TIMEOUT = config.getfloat('api', 'timeout')
+except (configparser.NoSectionError, configparser.NoOptionError):
+    API_TIMEOUT = 10
+try:
+    NOTIFY_MODE = config.get('global', 'notify_mode')
+except configparser.NoOptionError:
+    NOTIFY_MODE = 'api' if BACKEND == 'api' else 'pdns_control'
+try:
+    NOTIFY_TARGETS = [x.strip() for x in config.get('global', 'notify_targets').split(',')]
+except configparser.NoOptionError:
+    NOTIFY_TARGETS = SLAVES
+try:
+    NOTIFY_WORKERS = config.getint('global', 'notify_workers')
+except configparser.NoOptionError:
+    NOTIFY_WORKERS = 8
+try:
+    NOTIFY_TIMEOUT = config.getfloat('global', 'notify_timeout')
+except configparser.NoOptionError:
+    NOTIFY_TIMEOUT = 5
+try:
+    COMMIT_RETRIES = config.getint('global', 'commit_retries')
+except configparser.NoOptionError:
+    COMMIT_RETRIES = 3
+try:
+    APPLY_WORKERS = config.getint('global', 'apply_workers')
+except configparser.NoOptionError:
+    APPLY_WORKERS = 1
+try:
+    APPLY_MODE = config.get('global', 'apply_mode')
+except configparser.NoOptionError:
+    APPLY_MODE = 'atomic'
+
+try:
+    CACHE_TTL = config.getint('global', 'cache_ttl')
+except configparser.NoOptionError:
+    CACHE_TTL = 300
+
+try:
+    SLOW_QUERY_MS = config.getfloat('global', 'slow_query_ms')
+except configparser.NoOptionError:
+    SLOW_QUERY_MS = 1000
+try:
+    LISTEN_CHANGES = config.getboolean('global', 'listen_changes')
+except configparser.NoOptionError:
+    LISTEN_CHANGES = False
+try:
+    COLUMNAR_RECORDS = config.getint('global', 'columnar_records')
+except configparser.NoOptionError:
+    COLUMNAR_RECORDS = 100000
+try:
+    PREPARED_STATEMENTS = config.getboolean('postgres', 'prepared_statements')
+except (configparser.NoOptionError, configparser.NoSectionError):
+    PREPARED_STATEMENTS = True
 
 DEFAULT_TTL=360
 DEBUG = False
 
-dbconn = conn = psycopg2.connect("dbname=%s user=%s password=%s host=%s" % (dbname, dbuser, password, dbhost))
-db = conn.cursor()
+
+class QueryStats(object):
+    """Latency histograms, row counts and round trips of backend calls
+
+    Statements are keyed by their text with literals and VALUES lists
+    collapsed. Totals of the running command are kept in current and
+    moved to commands when it ends.
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.statements = {}
+        self.notifies = {}
+        self.commands = {}
+        self.command = None
+        self.current = [0, 0.0, 0]
+        self.last = None
+        self.retries = 0
+
+    @staticmethod
+    def normalize(statement):
+        if isinstance(statement, bytes):
+            statement = statement.decode('utf-8', 'replace')
+        statement = re.sub(r"'(?:[^']|'')*'", '?', statement)
+        statement = re.sub(r"\b\d+\b", '?', statement)
+        statement = re.sub(r"ARRAY\[[^\[\]]*\]", 'ARRAY[...]', statement)
+        statement = re.sub(r"(\([^()]*\))(\s*,\s*\([^()]*\))+", r"\1, ...", statement)
+        return ' '.join(statement.split())
+
+    @staticmethod
+    def kind(key):
+        """Statement verb and table, label for exported metrics"""
+        m = re.match(r"(\w+)\b.*?\b(?:FROM|INTO|UPDATE|JOIN)\s+(\w+)", key, re.I)
+        if m:
+            return ('%s %s' % (m.group(1), m.group(2))).upper()
+        return key.split(' ', 1)[0].upper()
+
+    def entry(self, table, key):
+        if key not in table:
+            table[key] = {'count': 0, 'seconds': 0.0, 'max': 0.0, 'rows': 0, 'buckets': [0] * len(self.BUCKETS)}
+        return table[key]
+
+    def observe(self, e, seconds):
+        e['count'] += 1
+        e['seconds'] += seconds
+        e['max'] = max(e['max'], seconds)
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                e['buckets'][i] += 1
+                break
+
+    def query(self, statement, seconds, rows=0):
+        """Record one round trip"""
+        key = self.normalize(statement)
+        with self.lock:
+            e = self.entry(self.statements, key)
+            self.observe(e, seconds)
+            e['rows'] += rows
+            self.current[0] += 1
+            self.current[1] += seconds
+            self.current[2] += rows
+        if DEBUG:
+            print("%.1f ms %d rows: %s" % (seconds * 1000, rows, key[:200]))
+        if SLOW_QUERY_MS and seconds * 1000 >= SLOW_QUERY_MS:
+            logging.getLogger('pdnscmd.slow').warning("%.1f ms %d rows: %s", seconds * 1000, rows, key)
+
+    def notify(self, mode, seconds, ok):
+        # rows of notify entries count failures
+        with self.lock:
+            e = self.entry(self.notifies, mode)
+            self.observe(e, seconds)
+            e['rows'] += 0 if ok else 1
+
+    def begin(self, command):
+        self.command = command
+        self.current = [0, 0.0, 0]
+
+    def end(self):
+        if self.command is None:
+            return
+        e = self.commands.setdefault(self.command, {'count': 0, 'round_trips': 0, 'seconds': 0.0, 'rows': 0})
+        e['count'] += 1
+        e['round_trips'] += self.current[0]
+        e['seconds'] += self.current[1]
+        e['rows'] += self.current[2]
+        self.last = (self.command, self.current)
+        self.command = None
+        self.current = [0, 0.0, 0]
+
+    def percentile(self, e, p):
+        """Upper bound of the bucket holding percentile p"""
+        n = 0
+        for i, count in enumerate(e['buckets']):
+            n += count
+            if n >= e['count'] * p:
+                return self.BUCKETS[i]
+        return e['max']
+
+    def histogram(self, name, label, table):
+        lines = ['# TYPE %s histogram' % name]
+        for key, e in sorted(table.items()):
+            total = 0
+            for bound, count in zip(self.BUCKETS, e['buckets']):
+                total += count
+                lines.append('%s_bucket{%s="%s",le="%s"} %d' % (name, label, key, bound, total))
+            lines.append('%s_bucket{%s="%s",le="+Inf"} %d' % (name, label, key, e['count']))
+            lines.append('%s_sum{%s="%s"} %f' % (name, label, key, e['seconds']))
+            lines.append('%s_count{%s="%s"} %d' % (name, label, key, e['count']))
+        return lines
+
+    def prometheus(self):
+        """Text exposition format for the node_exporter textfile collector"""
+        kinds = {}
+        for key, e in self.statements.items():
+            k = self.entry(kinds, self.kind(key))
+            for f in ['count', 'seconds', 'rows']:
+                k[f] += e[f]
+            k['buckets'] = [a + b for a, b in zip(k['buckets'], e['buckets'])]
+        lines = self.histogram('pdnscmd_query_duration_seconds', 'statement', kinds)
+        lines.append('# TYPE pdnscmd_query_rows_total counter')
+        for key, e in sorted(kinds.items()):
+            lines.append('pdnscmd_query_rows_total{statement="%s"} %d' % (key, e['rows']))
+        lines.append('# TYPE pdnscmd_commit_retries_total counter')
+        lines.append('pdnscmd_commit_retries_total %d' % self.retries)
+        lines += self.histogram('pdnscmd_notify_duration_seconds', 'mode', self.notifies)
+        lines.append('# TYPE pdnscmd_notify_failures_total counter')
+        for key, e in sorted(self.notifies.items()):
+            lines.append('pdnscmd_notify_failures_total{mode="%s"} %d' % (key, e['rows']))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, extra=()):
+        """Write metrics and extra (name, value) gauges to path atomically"""
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus())
+            for name, value in extra:
+                f.write('# TYPE %s gauge\n%s %s\n' % (name, name, value))
+        os.rename(tmp, path)
+
+
+stats = QueryStats()
+_cursor_class = None
+
+
+def instrumented_cursor():
+    """psycopg2 cursor class recording every round trip in stats
+
+    Statements whose result is not needed can be queued with queue().
+    psycopg2 has no libpq pipeline mode, queued statements are sent in
+    the same round trip as the next statement executed, or by flush().
+    Their errors are raised by that statement.
+    """
+    global _cursor_class
+    if _cursor_class is None:
+        import psycopg2.extensions
+
+        class InstrumentedCursor(psycopg2.extensions.cursor):
+            def __init__(self, *args, **kwargs):
+                super(InstrumentedCursor, self).__init__(*args, **kwargs)
+                self.pending = []
+
+            def queue(self, query, vars=None):
+                self.pending.append(self.mogrify(query, vars))
+
+            def flush(self):
+                if self.pending:
+                    self.execute(b';\n'.join(self.pending))
+
+            def discard(self):
+                self.pending = []
+
+            def execute(self, query, vars=None):
+                if self.pending:
+                    if not isinstance(query, bytes) or vars is not None:
+                        query = self.mogrify(query, vars)
+                    query, vars = b';\n'.join(self.pending + [query]), None
+                    self.pending = []
+                start = time.perf_counter()
+                try:
+                    return super(InstrumentedCursor, self).execute(query, vars)
+                finally:
+                    stats.query(self.query or query, time.perf_counter() - start, max(self.rowcount, 0))
+
+            def copy_expert(self, sql, file, size=8192):
+                self.flush()
+                start = time.perf_counter()
+                try:
+                    return super(InstrumentedCursor, self).copy_expert(sql, file, size)
+                finally:
+                    stats.query(sql, time.perf_counter() - start, max(self.rowcount, 0))
+
+        _cursor_class = InstrumentedCursor
+    return _cursor_class
+
+
+def dsn():
+    """Connection string, password is read from PowerDNS config if not set"""
+    global password
+    if not password:
+        f = open("/etc/powerdns/pdns.d/pdns.local.gpgsql", 'r')
+        for line in f.readlines():
+            if line.startswith('gpgsql-password='):
+                password = line.split('=', 1)[1].strip()
+        f.close()
+
+        if not password:
+            print("Cannot find postgres password")
+            sys.exit(1)
+    return "dbname=%s user=%s password=%s host=%s" % (dbname, dbuser, password, dbhost)
+
+
+def connect():
+    """Open database connection, psycopg2 is only imported here"""
+    import psycopg2
+    return psycopg2.connect(dsn(), cursor_factory=instrumented_cursor())
+
+
+class LazyConnection(object):
+    """Database connection opened on first use
+
+    A thread can be switched to another connection with thread_connection.
+    """
+
+    def __init__(self):
+        self.conn = None
+        self.local = threading.local()
+
+    @property
+    def connected(self):
+        return self.conn is not None
+
+    def current(self):
+        """psycopg2 connection of this thread"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            return conn
+        if self.conn is None:
+            self.conn = connect()
+        return self.conn
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+
+class LazyCursor(object):
+    """Cursor of a LazyConnection created on first use"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = None
+        self.local = threading.local()
+
+    def current(self):
+        """psycopg2 cursor of this thread"""
+        cursor = getattr(self.local, 'cursor', None)
+        if cursor is not None:
+            return cursor
+        if self.cursor is None:
+            self.cursor = self.connection.cursor()
+        return self.cursor
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+
+dbconn = LazyConnection()
+db = LazyCursor(dbconn)
+
+
+@contextmanager
+def thread_connection(conn):
+    """Make dbconn and db use conn in the current thread"""
+    dbconn.local.conn = conn
+    db.local.cursor = conn.cursor()
+    try:
+        yield conn
+    finally:
+        db.local.cursor.close()
+        db.local.cursor = None
+        dbconn.local.conn = None
+
+
+class PreparedStatements(object):
+    """Server side prepared statements of fixed query shapes
+
+    A statement is prepared on a connection the first time it is used
+    there and executed with EXECUTE name(...) afterwards. Prepared
+    statements are kept per connection until it is closed. Set
+    prepared_statements = no in [postgres] behind poolers that do not
+    keep sessions, like pgbouncer in transaction mode.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def positional(query):
+        """Query with %s placeholders numbered $1, $2, ..."""
+        counter = iter(range(1, query.count('%s') + 1))
+        return re.sub(r'%(%|s)', lambda m: '%%' if m.group(1) == '%' else '$%d' % next(counter), query)
+
+    @staticmethod
+    def arguments(query):
+        """EXECUTE argument list with the casts of the placeholders
+
+        Array literals of NULLs are text[] and not coerced to int[]
+        without the cast.
+        """
+        return ', '.join(['%s' + cast for m, cast in re.findall(r'%(%|s)((?:::[\w\[\]]+)?)', query) if m == 's'])
+
+    def execute(self, name, query, args=(), queue=False):
+        cursor = db.current()
+        if not PREPARED_STATEMENTS:
+            return (cursor.queue if queue else cursor.execute)(query, args)
+        with self.lock:
+            prepared = self.connections.setdefault(cursor.connection, set())
+        if name not in prepared:
+            cursor.execute("PREPARE %s AS %s" % (name, self.positional(query)), ())
+            prepared.add(name)
+        statement = "EXECUTE %s(%s)" % (name, self.arguments(query)) if args else "EXECUTE %s" % name
+        return (cursor.queue if queue else cursor.execute)(statement, args)
+
+
+statements = PreparedStatements()
+
+
+def execute_prepared(name, query, args=(), queue=False):
+    """Execute query on db as prepared statement name, queue it with queue"""
+    statements.execute(name, query, tuple(args), queue)
+
+
+cursor_counter = 0
+
+def iter_query(query, args=None, itersize=2000):
+    """Stream rows of query through a named server side cursor"""
+    global cursor_counter
+    cursor_counter += 1
+    db.flush()
+    cursor = dbconn.cursor(name='pdnscmd_%d' % cursor_counter)
+    try:
+        cursor.execute(query, args)
+        while True:
+            start = time.perf_counter()
+            rows = cursor.fetchmany(itersize)
+            stats.query('FETCH ' + query, time.perf_counter() - start, len(rows))
+            for row in rows:
+                yield row
+            if len(rows) < itersize:
+                break
+    finally:
+        cursor.close()
+
+CHANGE_CHANNEL = 'pdnscmd_changes'
+# Statements changing more rows notify only the zones
+CHANGE_ROWS = 100
+
+# Statement level triggers sending changed rows of domains and records to
+# CHANGE_CHANNEL. Statements over CHANGE_ROWS rows and payloads over the
+# 8000 byte limit carry only the zone ids, or nothing which means
+# everything may have changed.
+CHANGE_TRIGGERS = [
+    """CREATE OR REPLACE FUNCTION pdnscmd_records_notify() RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+  changed bigint;
+  removed json;
+  added json;
+  zones json;
+  payload text;
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    SELECT count(*) INTO changed FROM old_rows;
+  ELSIF TG_OP = 'INSERT' THEN
+    SELECT count(*) INTO changed FROM new_rows;
+  ELSE
+    SELECT count(*) INTO changed FROM old_rows o JOIN new_rows n ON n.id = o.id
+      WHERE (o.domain_id, o.name, o.type, o.ttl, o.prio, o.content)
+            IS DISTINCT FROM (n.domain_id, n.name, n.type, n.ttl, n.prio, n.content);
+  END IF;
+  IF changed = 0 THEN
+    RETURN NULL;
+  END IF;
+  IF changed > %(rows)d THEN
+    IF TG_OP = 'DELETE' THEN
+      SELECT json_agg(DISTINCT o.domain_id) INTO zones FROM old_rows o;
+    ELSIF TG_OP = 'INSERT' THEN
+      SELECT json_agg(DISTINCT n.domain_id) INTO zones FROM new_rows n;
+    ELSE
+      SELECT json_agg(DISTINCT z.domain_id) INTO zones
+        FROM (SELECT domain_id FROM old_rows UNION SELECT domain_id FROM new_rows) AS z;
+    END IF;
+    payload := json_build_object('table', 'records', 'zones', zones)::text;
+  ELSE
+    IF TG_OP = 'DELETE' THEN
+      SELECT json_agg(json_build_array(o.domain_id, o.name, o.type, o.ttl, o.prio, o.content)) INTO removed
+        FROM old_rows o WHERE o.type IS NOT NULL;
+    ELSIF TG_OP = 'INSERT' THEN
+      SELECT json_agg(json_build_array(n.domain_id, n.name, n.type, n.ttl, n.prio, n.content)) INTO added
+        FROM new_rows n WHERE n.type IS NOT NULL;
+    ELSE
+      SELECT json_agg(json_build_array(o.domain_id, o.name, o.type, o.ttl, o.prio, o.content)),
+             json_agg(json_build_array(n.domain_id, n.name, n.type, n.ttl, n.prio, n.content)) INTO removed, added
+        FROM old_rows o JOIN new_rows n ON n.id = o.id
+        WHERE (o.domain_id, o.name, o.type, o.ttl, o.prio, o.content)
+              IS DISTINCT FROM (n.domain_id, n.name, n.type, n.ttl, n.prio, n.content);
+    END IF;
+    IF removed IS NULL AND added IS NULL THEN
+      RETURN NULL;
+    END IF;
+    payload := json_build_object('table', 'records', 'removed', removed, 'added', added)::text;
+    IF octet_length(payload) > 7900 THEN
+      SELECT json_agg(DISTINCT (x->>0)::int) INTO zones
+        FROM (SELECT json_array_elements(removed) AS x UNION ALL SELECT json_array_elements(added)) AS e;
+      payload := json_build_object('table', 'records', 'zones', zones)::text;
+    END IF;
+  END IF;
+  IF octet_length(payload) > 7900 THEN
+    payload := json_build_object('table', 'records')::text;
+  END IF;
+  PERFORM pg_notify('%(channel)s', payload);
+  RETURN NULL;
+END $$""",
+    """CREATE OR REPLACE FUNCTION pdnscmd_domains_notify() RETURNS trigger LANGUAGE plpgsql AS $$
+DECLARE
+  changed bigint;
+  removed json;
+  added json;
+  payload text;
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    SELECT count(*) INTO changed FROM old_rows;
+  ELSIF TG_OP = 'INSERT' THEN
+    SELECT count(*) INTO changed FROM new_rows;
+  ELSE
+    SELECT count(*) INTO changed FROM old_rows o JOIN new_rows n ON n.id = o.id WHERE o.name IS DISTINCT FROM n.name;
+  END IF;
+  IF changed = 0 THEN
+    RETURN NULL;
+  END IF;
+  IF changed > %(rows)d THEN
+    PERFORM pg_notify('%(channel)s', json_build_object('table', 'domains')::text);
+    RETURN NULL;
+  END IF;
+  IF TG_OP = 'DELETE' THEN
+    SELECT json_agg(o.name) INTO removed FROM old_rows o;
+  ELSIF TG_OP = 'INSERT' THEN
+    SELECT json_agg(n.name) INTO added FROM new_rows n;
+  ELSE
+    SELECT json_agg(o.name), json_agg(n.name) INTO removed, added
+      FROM old_rows o JOIN new_rows n ON n.id = o.id WHERE o.name IS DISTINCT FROM n.name;
+  END IF;
+  payload := json_build_object('table', 'domains', 'removed', removed, 'added', added)::text;
+  IF octet_length(payload) > 7900 THEN
+    payload := json_build_object('table', 'domains')::text;
+  END IF;
+  PERFORM pg_notify('%(channel)s', payload);
+  RETURN NULL;
+END $$""",
+]
+for _table in ('records', 'domains'):
+    for _event, _tables in (('INSERT', 'NEW TABLE AS new_rows'), ('UPDATE', 'OLD TABLE AS old_rows NEW TABLE AS new_rows'),
+                            ('DELETE', 'OLD TABLE AS old_rows')):
+        CHANGE_TRIGGERS.append("DROP TRIGGER IF EXISTS pdnscmd_%s_%s ON %s" % (_table, _event.lower(), _table))
+        CHANGE_TRIGGERS.append("CREATE TRIGGER pdnscmd_%s_%s AFTER %s ON %s REFERENCING %s "
+                               "FOR EACH STATEMENT EXECUTE PROCEDURE pdnscmd_%s_notify()"
+                               % (_table, _event.lower(), _event, _table, _tables, _table))
+
+
+class ChangeListener(object):
+    """LISTEN to changes other sessions commit, see CHANGE_TRIGGERS
+
+    Uses its own autocommit connection. Notifications sent by the
+    connections in pids, the ones of this session, are skipped.
+    """
+
+    def __init__(self):
+        self.conn = connect()
+        self.conn.autocommit = True
+        self.conn.cursor().execute("LISTEN %s" % CHANGE_CHANNEL)
+
+    def poll(self, pids=()):
+        """Changes received since the last poll as dicts of the payload"""
+        self.conn.poll()
+        changes = []
+        while self.conn.notifies:
+            notify = self.conn.notifies.pop(0)
+            if notify.pid in pids:
+                continue
+            try:
+                changes.append(json.loads(notify.payload))
+            except ValueError:
+                changes.append({})
+        return changes
+
+    def close(self):
+        self.conn.close()
+
 
 def notify_domain(domain):
-    p = subprocess.call(['pdns_control', 'notify', domain], timeout=5)
+    return subprocess.call(['pdns_control', 'notify', domain], timeout=NOTIFY_TIMEOUT)
+
+
+def notify_packet(zone, qid):
+    """DNS NOTIFY query for zone SOA"""
+    qname = b''.join([struct.pack('B', len(x)) + x.encode('ascii') for x in zone.split('.') if x])
+    # opcode NOTIFY (4), authoritative answer
+    return struct.pack('!HHHHHH', qid, 0x2400, 1, 0, 0, 0) + qname + b'\0' + struct.pack('!HH', 6, 1)
+
+
+def send_notify(zone, target, timeout=NOTIFY_TIMEOUT):
+    """Send DNS NOTIFY for zone to target host[:port] and wait for the answer"""
+    host, port = target, 53
+    if target.startswith('['):
+        host, _, port = target[1:].partition(']:')
+    elif target.count(':') == 1:
+        host, port = target.split(':')
+    family, socktype, proto, canonname, address = socket.getaddrinfo(host, int(port or 53), 0, socket.SOCK_DGRAM)[0]
+    qid = random.randint(0, 0xffff)
+    s = socket.socket(family, socktype, proto)
+    try:
+        s.settimeout(timeout)
+        s.sendto(notify_packet(zone, qid), address)
+        while True:
+            data = s.recv(512)
+            if len(data) < 12:
+                continue
+            rid, flags = struct.unpack('!HH', data[:4])
+            if rid != qid or not flags & 0x8000:
+                continue
+            if flags & 0xf:
+                raise CommandException("rcode %d" % (flags & 0xf))
+            return True
+    finally:
+        s.close()
+
+
+class NotifyResult(object):
+    def __init__(self, zone, target, ok, elapsed, error=None):
+        self.zone = zone
+        self.target = target
+        self.ok = ok
+        self.elapsed = elapsed
+        self.error = error
+
+    def as_dict(self):
+        return {'zone': self.zone, 'target': self.target, 'ok': self.ok,
+                'elapsed': round(self.elapsed, 4), 'error': self.error}
+
+    def __str__(self):
+        if self.ok:
+            return "Notified %s via %s in %.3fs" % (self.zone, self.target, self.elapsed)
+        return "Notify %s via %s failed after %.3fs: %s" % (self.zone, self.target, self.elapsed, self.error)
+
+
+class NotifyDispatcher(object):
+    """Notify zones concurrently with a bounded worker pool
+
+    Mode pdns_control runs pdns_control notify per zone, native sends DNS
+    NOTIFY packets straight to every target (notify_targets, slaves by
+    default) and api asks the PowerDNS HTTP API to notify.
+    """
+
+    def __init__(self, mode=None, workers=None, targets=None, timeout=None):
+        self.mode = mode or NOTIFY_MODE
+        self.workers = workers or NOTIFY_WORKERS
+        self.targets = targets if targets is not None else NOTIFY_TARGETS
+        self.timeout = timeout or NOTIFY_TIMEOUT
+        if self.mode not in ['pdns_control', 'native', 'api']:
+            raise CommandException("Invalid notify mode %s" % self.mode)
+
+    def jobs(self, zones):
+        for zone in OrderedDict.fromkeys(zones):
+            if self.mode == 'native':
+                for target in self.targets:
+                    yield zone, target
+            else:
+                yield zone, self.mode
+
+    def run(self, zone, target):
+        start = time.time()
+        try:
+            if self.mode == 'native':
+                send_notify(zone, target, self.timeout)
+            elif self.mode == 'api':
+                backend().notify(zone)
+            elif notify_domain(zone) != 0:
+                raise CommandException("pdns_control failed")
+        except (CommandException, OSError, subprocess.SubprocessError) as e:
+            stats.notify(self.mode, time.time() - start, False)
+            return NotifyResult(zone, target, False, time.time() - start, str(e) or e.__class__.__name__)
+        stats.notify(self.mode, time.time() - start, True)
+        return NotifyResult(zone, target, True, time.time() - start)
+
+    def notify(self, zones):
+        """Notify zones, return NotifyResult for every zone and target"""
+        from concurrent.futures import ThreadPoolExecutor
+        jobs = list(self.jobs(zones))
+        if not jobs:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(jobs))) as pool:
+            return list(pool.map(lambda x: self.run(*x), jobs))
 
 
 class CommandException(Exception):
@@ -90,6 +771,11 @@ class RecordActions(object):
 
 
 class Record(Task):
+    # Deletes that may be dropped if the record is missing
+    optional = False
+    # PTR queued for an A or AAAA record without checking the reverse zone
+    reverse = False
+
     def __init__(self, key, rtype, value, domain, ttl=None, priority=None, action=RecordActions.ADD):
         if key == '@' or key == '':
             self.key = domain.domain
@@ -104,19 +790,24 @@ class Record(Task):
         self.domain = domain
         self.action = action
 
-    def execute(self):
+    def columns(self):
         args = ['name', 'type', 'content', 'domain_id']
         values = [self.key, self.rtype, self.value, self.domain.zone_id]
-        self.domain.clear_records()
         for k, v in (('ttl', self.ttl), ('prio', self.priority),):
             if v is not None:
                 args.append(k)
                 values.append(v)
+        return args, values
+
+    def execute(self):
+        args, values = self.columns()
 
         if self.action == RecordActions.DELETE:
-            db.execute("DELETE FROM records WHERE " + ' and '.join(["%s=%%s" % k for k in args]) + " RETURNING id", values)
+            execute_prepared('record_delete_' + '_'.join(args),
+                             "DELETE FROM records WHERE " + ' and '.join(["%s=%%s" % k for k in args]) + " RETURNING id", values)
         elif self.action == RecordActions.ADD:
-            db.execute("INSERT INTO records (" + ', '.join(args) + ") VALUES (" + ','.join(['%s']*len(values)) + ") RETURNING id", values)
+            execute_prepared('record_insert_' + '_'.join(args),
+                             "INSERT INTO records (" + ', '.join(args) + ") VALUES (" + ','.join(['%s']*len(values)) + ") RETURNING id", values)
         else:
             raise NotImplemented("Update not implemented")
         if db.fetchone():
@@ -134,13 +825,280 @@ class Record(Task):
         else:
             return "ADD record %s" % record
 
+    def row(self):
+        return RecordRow(self.key, self.rtype, self.ttl, self.priority, self.value)
+
+
+def _int_or_none(value):
+    if value is None or value == '' or value == '-':
+        return None
+    return int(value)
+
+
+class RecordRow(object):
+    """One loaded record, ttl and priority are ints or None"""
+
+    __slots__ = ('key', 'type', 'ttl', 'priority', 'value')
+
+    def __init__(self, key, rtype, ttl, priority, value):
+        self.key = key
+        self.type = sys.intern(rtype or '-')
+        self.ttl = _int_or_none(ttl)
+        self.priority = _int_or_none(priority)
+        self.value = value or '-'
+
+    @classmethod
+    def from_row(cls, row):
+        """From a (name, type, ttl, prio, content) tuple"""
+        return cls(row[0], row[1], row[2], row[3], row[4])
+
+    def matches(self, rtype, value, ttl=None, priority=None):
+        """Would DELETE with these columns remove this row"""
+        return (self.type == rtype and self.value == value and
+                (ttl is None or self.ttl == _int_or_none(ttl)) and
+                (priority is None or self.priority == _int_or_none(priority)))
+
+    def __eq__(self, other):
+        return isinstance(other, RecordRow) and \
+            (self.key, self.type, self.ttl, self.priority, self.value) == \
+            (other.key, other.type, other.ttl, other.priority, other.value)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'RecordRow(%r, %r, %r, %r, %r)' % (self.key, self.type, self.ttl, self.priority, self.value)
+
+
+class RecordStore(object):
+    """Records of one zone indexed by name
+
+    Rows are RecordRow objects, all rows of a name share its key string.
+    """
+
+    def __init__(self, rows=()):
+        self.names = {}
+        self._sorted = None
+        self.count = 0
+        for row in rows:
+            self.add(row)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for name in self.sorted_names():
+            for row in self.names[name]:
+                yield row
+
+    def sorted_names(self):
+        if self._sorted is None:
+            self._sorted = sorted(self.names)
+        return self._sorted
+
+    def get(self, name, rtype=None):
+        return [x for x in self.names.get(name, ()) if rtype is None or x.type == rtype]
+
+    def contains(self, name, rtype, value, priority=None):
+        for row in self.get(name, rtype):
+            if row.matches(rtype, value, priority=priority):
+                return True
+        return False
+
+    def names_with_prefix(self, prefix):
+        names = self.sorted_names()
+        i = bisect_left(names, prefix)
+        while i < len(names) and names[i].startswith(prefix):
+            yield names[i]
+            i += 1
+
+    def add(self, row):
+        rows = self.names.get(row.key)
+        if rows is None:
+            rows = self.names[row.key] = []
+            self._sorted = None
+        else:
+            row.key = rows[0].key
+        rows.append(row)
+        self.count += 1
+
+    def remove(self, name, rtype, value, ttl=None, priority=None):
+        """Remove rows like DELETE with the same columns would"""
+        rows = self.names.get(name, [])
+        removed = [x for x in rows if x.matches(rtype, value, ttl, priority)]
+        for row in removed:
+            rows.remove(row)
+            self.count -= 1
+        if not rows and name in self.names:
+            del self.names[name]
+            self._sorted = None
+        return removed
+
+
+class ColumnarRecordStore(object):
+    """RecordStore for large zones keeping the columns in flat arrays
+
+    Names relative to suffix and contents are utf-8 blobs with offset
+    arrays, types are indexes to a small table and ttl and priority
+    machine ints with -1 for NULL, priorities only once a row has one.
+    Rows of a name must arrive next to each other, order holds name
+    indexes sorted for bisect. RecordRow objects are built on access
+    only. Changes after loading go to an overlay RecordStore, removed
+    base rows are remembered by index.
+    """
+
+    def __init__(self, rows=(), suffix=''):
+        self.suffix = suffix
+        self.name_blob = bytearray()
+        self.name_offsets = array('I', [0])
+        self.row_starts = array('I', [0])
+        self.types = array('B')
+        self.type_table = []
+        self.type_codes = {}
+        self.ttls = array('i')
+        self.priorities = None
+        self.value_blob = bytearray()
+        self.value_offsets = array('I', [0])
+        self.removed = set()
+        self.overlay = RecordStore()
+        last = None
+        ordered = True
+        for row in rows:
+            if not isinstance(row, RecordRow):
+                row = RecordRow.from_row(row)
+            if row.key != last:
+                if last is not None:
+                    self.row_starts.append(len(self.types))
+                    ordered = ordered and last < row.key
+                self.name_blob += self._relative(row.key).encode('utf-8')
+                self.name_offsets.append(len(self.name_blob))
+                last = row.key
+            if row.type not in self.type_codes:
+                self.type_codes[row.type] = len(self.type_table)
+                self.type_table.append(row.type)
+            if row.priority is not None and self.priorities is None:
+                self.priorities = array('i', [-1]) * len(self.types)
+            self.types.append(self.type_codes[row.type])
+            self.ttls.append(-1 if row.ttl is None else row.ttl)
+            if self.priorities is not None:
+                self.priorities.append(-1 if row.priority is None else row.priority)
+            self.value_blob += row.value.encode('utf-8')
+            self.value_offsets.append(len(self.value_blob))
+        if last is not None:
+            self.row_starts.append(len(self.types))
+        self.name_blob = bytes(self.name_blob)
+        self.value_blob = bytes(self.value_blob)
+        if ordered:
+            self.order = array('I', range(self.name_count()))
+        else:
+            self.order = array('I', sorted(range(self.name_count()), key=self._name))
+
+    def _relative(self, name):
+        """Stored form of name: '' for suffix, absolute names end with a dot"""
+        if name == self.suffix:
+            return ''
+        if self.suffix and name.endswith('.' + self.suffix):
+            return name[:-len(self.suffix) - 1]
+        return name + '.'
+
+    def name_count(self):
+        return len(self.name_offsets) - 1
+
+    def _name(self, n):
+        name = self.name_blob[self.name_offsets[n]:self.name_offsets[n + 1]].decode('utf-8')
+        if not name:
+            return self.suffix
+        if name.endswith('.'):
+            return name[:-1]
+        return name + '.' + self.suffix if self.suffix else name
+
+    def _row(self, i, key):
+        ttl = self.ttls[i]
+        priority = -1 if self.priorities is None else self.priorities[i]
+        return RecordRow(key, self.type_table[self.types[i]], None if ttl == -1 else ttl,
+                         None if priority == -1 else priority,
+                         self.value_blob[self.value_offsets[i]:self.value_offsets[i + 1]].decode('utf-8'))
+
+    def _bisect(self, name):
+        lo, hi = 0, len(self.order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(self.order[mid]) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _indexes(self, name):
+        i = self._bisect(name)
+        if i < len(self.order) and self._name(self.order[i]) == name:
+            n = self.order[i]
+            return [x for x in range(self.row_starts[n], self.row_starts[n + 1]) if x not in self.removed]
+        return []
+
+    def _base(self, n):
+        key = self._name(n)
+        return [self._row(x, key) for x in range(self.row_starts[n], self.row_starts[n + 1]) if x not in self.removed]
+
+    def __len__(self):
+        return len(self.types) - len(self.removed) + len(self.overlay)
+
+    def __iter__(self):
+        base = (row for n in self.order for row in self._base(n))
+        return heapq.merge(base, iter(self.overlay), key=lambda x: x.key)
+
+    def get(self, name, rtype=None):
+        key = None
+        rows = []
+        for i in self._indexes(name):
+            if rtype is None or self.type_table[self.types[i]] == rtype:
+                key = key or name
+                rows.append(self._row(i, key))
+        return rows + self.overlay.get(name, rtype)
+
+    def contains(self, name, rtype, value, priority=None):
+        for row in self.get(name, rtype):
+            if row.matches(rtype, value, priority=priority):
+                return True
+        return False
+
+    def names_with_prefix(self, prefix):
+        def base():
+            i = self._bisect(prefix)
+            while i < len(self.order):
+                n = self.order[i]
+                name = self._name(n)
+                if not name.startswith(prefix):
+                    break
+                if any(x not in self.removed for x in range(self.row_starts[n], self.row_starts[n + 1])):
+                    yield name
+                i += 1
+        last = None
+        for name in heapq.merge(base(), self.overlay.names_with_prefix(prefix)):
+            if name != last:
+                yield name
+                last = name
+
+    def add(self, row):
+        self.overlay.add(row)
+
+    def remove(self, name, rtype, value, ttl=None, priority=None):
+        """Remove rows like DELETE with the same columns would"""
+        removed = []
+        for i in self._indexes(name):
+            row = self._row(i, name)
+            if row.matches(rtype, value, ttl, priority):
+                self.removed.add(i)
+                removed.append(row)
+        return removed + self.overlay.remove(name, rtype, value, ttl, priority)
+
 
 class Domain(Task):
-    def __init__(self, domain):
+    def __init__(self, domain, zone_id=None):
         self.domain = domain.rstrip('.')
-        self._records = []
-        self.zone_id = None
-        self.exists()
+        self._records = None
+        self.zone_id = zone_id
+        if zone_id is None:
+            self.exists()
         self.to_delete = False
 
     def validate(self):
@@ -149,10 +1107,9 @@ class Domain(Task):
         return True
 
     def exists(self):
-        db.execute("SELECT name, id from domains where name = %s", (self.domain,))
-        res = db.fetchone()
-        if res:
-            self.zone_id = int(res[1])
+        zone_id = backend().zone_id(self.domain)
+        if zone_id is not None:
+            self.zone_id = zone_id
             return True
         else:
             return False
@@ -165,126 +1122,1849 @@ class Domain(Task):
         return ""
 
     def clear_records(self):
-        self._records = []
+        self._records = None
+
+    def apply_change(self, record):
+        """Update loaded records after record task was committed"""
+        if self._records is None:
+            return
+        if record.action == RecordActions.DELETE:
+            self._records.remove(record.key, record.rtype, record.value, record.ttl, record.priority)
+        else:
+            self._records.add(record.row())
 
     def _format_record(self, row):
         return {
             'key': row[0],
             'type': row[1] or '-',
             'ttl': row[2] or '-',
-            'priority': row[3] or '-',
+            'priority': '-' if row[3] is None or row[3] == '' else '%s' % (row[3],),
             'value': row[4] or '-'
         }
 
+    def iter_rows(self, keywords=(), limit=None, offset=0):
+        """Stream (name, type, ttl, prio, content) rows of the zone
+
+        Rows can be filtered with keywords matching name or content, or
+        the type exactly, and paged with limit and offset.
+        """
+        if self.zone_id is None:
+            return iter([])
+        return backend().iter_records(self, keywords, limit, offset)
+
     def update_records(self):
-        db.execute("SELECT name, type, ttl, coalesce(prio::text,''), content FROM records WHERE domain_id = %s ORDER BY name, type, content", (self.zone_id,))
-        self._records = [{'key': x[0], 'type': x[1] or '-', 'ttl': x[2] or '-', 'priority': x[3] or '-', 'value': x[4] or '-'} for x in db.fetchall()]
+        """Load records, zones over columnar_records rows get a ColumnarRecordStore"""
+        if self.zone_id is None:
+            self._records = RecordStore()
+            return
+        rows = iter(backend().iter_records(self))
+        head = list(islice(rows, COLUMNAR_RECORDS))
+        if len(head) < COLUMNAR_RECORDS:
+            self._records = RecordStore(RecordRow.from_row(x) for x in head)
+        else:
+            self._records = ColumnarRecordStore(chain(head, rows), self.domain)
 
     def records(self):
-        if not self._records:
+        if self._records is None:
             self.update_records()
         return self._records
 
-    def fqdn(self, key):
-        key = key.strip('.')
-        if key == '@':
-            key = self.domain
-        elif not key.endswith(self.domain):
-            key = '%s.%s' % (key, self.domain)
-        return key.lower()
+    def fqdn(self, key):
+        key = key.strip('.')
+        if key in ['@', '']:
+            key = self.domain
+        elif not key.endswith(self.domain):
+            key = '%s.%s' % (key, self.domain)
+        return key.lower()
+
+    def exists_record(self, key, rtype, value, priority=None):
+        key = self.fqdn(key)
+        return self.records().contains(key, rtype, value, priority)
+
+    def get_records(self, key, rtype=None, value=None):
+        key = self.fqdn(key)
+        return [x for x in self.records().get(key, rtype) if value is None or x.value == value]
+
+    """
+         Column      |          Type          |                      Modifiers                       | Storage  | Stats target | Description
+    -----------------+------------------------+------------------------------------------------------+----------+--------------+-------------
+     id              | integer                | not null default nextval('domains_id_seq'::regclass) | plain    |              |
+     name            | character varying(255) | not null                                             | extended |              |
+     master          | character varying(128) | default NULL::character varying                      | extended |              |
+     last_check      | integer                |                                                      | plain    |              |
+     type            | character varying(6)   | not null                                             | extended |              |
+     notified_serial | integer                |                                                      | plain    |              |
+     account         | character varying(40)  | default NULL::character varying                      | extended |              |
+    """
+
+    """
+
+        Column    |           Type           |                      Modifiers                       | Storage  | Stats target | Description
+    --------------+--------------------------+------------------------------------------------------+----------+--------------+-------------
+      id          | integer                  | not null default nextval('records_id_seq'::regclass) | plain    |              |
+      domain_id   | integer                  |                                                      | plain    |              |
+      name        | character varying(255)   | default NULL::character varying                      | extended |              |
+      type        | character varying(10)    | default NULL::character varying                      | extended |              |
+      content     | character varying(65535) | default NULL::character varying                      | extended |              |
+      ttl         | integer                  |                                                      | plain    |              |
+      prio        | integer                  |                                                      | plain    |              |
+      change_date | integer                  |                                                      | plain    |              |
+      disabled    | boolean                  | default false                                        | plain    |              |
+      ordername   | character varying(255)   |                                                      | extended |              |
+      auth        | boolean                  | default true                                         | plain    |              |
+
+    """
+
+    def create(self):
+        if self.exists():
+            return
+        self.zone_id = backend().create_domain(self.domain)
+
+    def inc_serial(self):
+        inc_serials([self])
+
+    def delete(self):
+        if not self.exists():
+            return
+        backend().delete_domain(self)
+
+    def execute(self):
+        if self.to_delete:
+            self.delete()
+        else:
+            self.create()
+
+
+def inc_serials(domains):
+    """Queue the SOA serial bump of all given domains as one UPDATE
+
+    New serial is max(serial + 1, YYYYMMDD01). The new content is computed
+    from the row being updated, a concurrent bump of the same zone waits
+    for the row lock and then increments the committed serial.
+    """
+    zone_ids = list(set([d.zone_id for d in domains if d.zone_id is not None]))
+    if not zone_ids:
+        return
+    alt = int(datetime.now().strftime('%Y%m%d01'))
+    # nothing is read back, the UPDATE goes out with the next statement
+    execute_prepared('bump_serials',
+                     "UPDATE records SET content = (SELECT array_to_string(soa[1:2] || "
+                     "greatest(soa[3]::bigint + 1, %s::bigint)::text || soa[4:array_length(soa, 1)], ' ') "
+                     "FROM regexp_split_to_array(trim(records.content), '\\s+') AS soa) "
+                     "WHERE type = 'SOA' and domain_id = ANY(%s::int[])", (alt, zone_ids), queue=True)
+
+
+# Advisory lock namespace, first key of pg_advisory_xact_lock(int, int)
+ZONE_LOCK_CLASS = 0x70646e73
+
+
+def shard_tasks(tasks):
+    """Record tasks grouped by zone id, None if other tasks are queued"""
+    shards = OrderedDict()
+    for t in tasks:
+        if not isinstance(t, (Record, ZoneImport)) or t.domain.zone_id is None:
+            return None
+        shards.setdefault(t.domain.zone_id, []).append(t)
+    return shards
+
+
+def task_zone_ids(tasks):
+    """Ids of existing zones tasks write to"""
+    zone_ids = set()
+    for t in tasks:
+        domains = getattr(t, 'deleted', None) or [getattr(t, 'domain', None)]
+        zone_ids.update([d.zone_id for d in domains if isinstance(d, Domain) and d.zone_id is not None])
+    return sorted(zone_ids)
+
+
+class SqlBackend(object):
+    """Changes written straight to the PowerDNS gpgsql tables"""
+
+    name = 'gpgsql'
+    parallel = True
+
+    def __init__(self):
+        self.pool = None
+        # Connections apply_parallel took part in the open transaction with
+        self.prepared = []
+        self.prepared_lock = threading.Lock()
+        self.pids = set()
+        self.triggers = None
+        self.api = None
+
+    @property
+    def errors(self):
+        import psycopg2
+        return (psycopg2.Error,)
+
+    def zone_id(self, name):
+        execute_prepared('zone_id', "SELECT name, id from domains where name = %s::text", (name,))
+        res = db.fetchone()
+        if res:
+            return int(res[1])
+        return None
+
+    def zone_names(self):
+        execute_prepared('zone_names', "SELECT name FROM domains")
+        return [x[0] for x in db.fetchall()]
+
+    VALIDATE_PAGE = 10000
+
+    def existing(self, records):
+        """Whether each record task matches a row, one query per page
+
+        Deletes with ttl only match rows with that ttl.
+        """
+        found = set()
+        for start in range(0, len(records), self.VALIDATE_PAGE):
+            page = records[start:start + self.VALIDATE_PAGE]
+            execute_prepared('existing_records',
+                             "SELECT v.idx FROM unnest(%s::int[], %s::int[], %s::text[], %s::text[], %s::text[], %s::int[], %s::int[]) "
+                             "AS v (idx, domain_id, name, type, content, prio, ttl) WHERE EXISTS ("
+                             "SELECT 1 FROM records r WHERE r.domain_id = v.domain_id AND r.name = v.name AND r.type = v.type "
+                             "AND r.content = v.content AND (v.prio IS NULL OR r.prio = v.prio) "
+                             "AND (v.ttl IS NULL OR r.ttl = v.ttl))",
+                             (list(range(start, start + len(page))),
+                              [t.domain.zone_id for t in page],
+                              [t.key for t in page],
+                              [t.rtype for t in page],
+                              [t.value for t in page],
+                              [t.priority for t in page],
+                              [t.ttl if t.action == RecordActions.DELETE else None for t in page]))
+            found.update([x[0] for x in db.fetchall()])
+        return [i in found for i in range(len(records))]
+
+    def contents(self, records):
+        """Stored contents of the name and type of each record task
+
+        Returns dict of (zone_id, name, type) to set of contents, one
+        query per page.
+        """
+        result = {}
+        for start in range(0, len(records), self.VALIDATE_PAGE):
+            page = records[start:start + self.VALIDATE_PAGE]
+            execute_prepared('record_contents',
+                             "SELECT r.domain_id, r.name, r.type, r.content FROM records r "
+                             "JOIN unnest(%s::int[], %s::text[], %s::text[]) AS v (domain_id, name, type) "
+                             "ON r.domain_id = v.domain_id AND r.name = v.name AND r.type = v.type",
+                             ([t.domain.zone_id for t in page], [t.key for t in page], [t.rtype for t in page]))
+            for zone_id, name, rtype, content in db.fetchall():
+                result.setdefault((zone_id, name, rtype), set()).add(content)
+        return result
+
+    def zone_ids(self, names):
+        """Ids of the existing ones of names"""
+        execute_prepared('zone_ids', "SELECT name, id FROM domains WHERE name = ANY(%s::text[])", (list(names),))
+        return dict(db.fetchall())
+
+    def match_zones(self, patterns):
+        """Names and ids of zones matching any of shell style patterns"""
+        db.execute("SELECT name, id FROM domains WHERE name LIKE ANY(%s)", ([glob_like(x) for x in patterns],))
+        return dict(db.fetchall())
+
+    def dangling_ptrs(self, zone_ids):
+        """PTR records in other zones pointing to names in zones
+
+        Returns (zone, zone_id, name, ttl, content) rows.
+        """
+        db.execute("SELECT DISTINCT r.name, p.domain_id, p.name, p.ttl, p.content "
+                   "FROM (SELECT DISTINCT name FROM records WHERE domain_id = ANY(%s)) f "
+                   "JOIN records p ON p.type = 'PTR' AND rtrim(p.content, '.') = f.name "
+                   "JOIN domains r ON r.id = p.domain_id "
+                   "WHERE p.domain_id <> ALL(%s)", (list(zone_ids), list(zone_ids)))
+        return db.fetchall()
+
+    def iter_domains(self):
+        return iter_query("SELECT name, type, notified_serial FROM domains ORDER BY name")
+
+    def iter_records(self, domain, keywords=(), limit=None, offset=0):
+        for row in self.search_records(zone_id=domain.zone_id, keywords=keywords, limit=limit, offset=offset):
+            yield row[1:]
+
+    def search_records(self, zone_id=None, keywords=(), name=None, rtype=None, content=None,
+                       regex=None, limit=None, offset=0):
+        """Stream (zone, name, type, ttl, prio, content) rows matching all given filters
+
+        keywords match as substring of name or content or equal the type,
+        any of them is enough. name, rtype and content match exactly,
+        regex matches name or content.
+        """
+        # empty non-terminals are not records
+        where = ["r.type IS NOT NULL"]
+        args = []
+        for column, value in (('r.domain_id', zone_id), ('r.name', name), ('r.type', rtype), ('r.content', content)):
+            if value is not None:
+                where.append("%s = %%s" % column)
+                args.append(value)
+        if regex is not None:
+            where.append("(r.name ~ %s or r.content ~ %s)")
+            args.extend([regex, regex])
+        if keywords:
+            # every branch has an index of createindexes, so they can be ORed
+            where.append('(' + ' or '.join(["r.name LIKE %s or r.type = %s or r.content LIKE %s"] * len(keywords)) + ')')
+            for k in keywords:
+                args.extend([like_pattern(k), k.upper(), like_pattern(k)])
+        query = "SELECT d.name, r.name, r.type, r.ttl, r.prio, r.content FROM records r JOIN domains d ON d.id = r.domain_id"
+        query += " WHERE " + ' and '.join(where)
+        query += " ORDER BY d.name, r.name, r.type, r.content"
+        if limit is not None:
+            query += " LIMIT %d" % limit
+        if offset:
+            query += " OFFSET %d" % offset
+        return iter_query(query, args)
+
+    def create_indexes(self):
+        """Create indexes used by search_records, returns statements run"""
+        statements = [
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+            "CREATE INDEX IF NOT EXISTS pdnscmd_records_content_idx ON records USING hash (content)",
+            "CREATE INDEX IF NOT EXISTS pdnscmd_records_content_trgm_idx ON records USING gin (content gin_trgm_ops)",
+            "CREATE INDEX IF NOT EXISTS pdnscmd_records_name_trgm_idx ON records USING gin (name gin_trgm_ops)",
+            "CREATE INDEX IF NOT EXISTS pdnscmd_records_type_idx ON records (type)",
+        ]
+        for statement in statements:
+            db.execute(statement)
+        dbconn.commit()
+        return statements
+
+    def install_triggers(self):
+        """Create the triggers ChangeListener listens to, returns statements run"""
+        statements = [x % {'channel': CHANGE_CHANNEL, 'rows': CHANGE_ROWS} if '%(' in x else x
+                      for x in CHANGE_TRIGGERS]
+        for statement in statements:
+            db.execute(statement)
+        dbconn.commit()
+        self.triggers = True
+        return statements
+
+    def change_triggers(self):
+        """Whether the triggers of install_triggers exist, looked up once
+
+        Transactions that sent a NOTIFY cannot be prepared for two-phase
+        commit.
+        """
+        if self.triggers is None:
+            db.execute("SELECT EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = 'records'::regclass "
+                       "AND left(tgname, 8) = 'pdnscmd_')")
+            self.triggers = db.fetchone()[0]
+        return self.triggers
+
+    def audit_reverses(self):
+        """Compare A/AAAA records and PTRs of all zones, see DNSCommander.do_audit
+
+        Both record sets are copied out, their addresses parsed and copied
+        into temporary tables that are joined on inet. Yields (problem, ip,
+        names, ptr, covered) with problem missing, dangling or mismatched,
+        names of the forward records of ip, ptr (zone_id, zone, name, ttl,
+        target) and covered telling if another PTR of ip is correct.
+        """
+        def forward(fields):
+            ip = parse_ip(fields[1])
+            return (ip, fields[0].lower()) if ip else None
+
+        def reverse(fields):
+            ip = reverse_ip(fields[1])
+            return (ip,) + tuple(fields) if ip else None
+
+        db.execute("DROP TABLE IF EXISTS pdnscmd_audit_forward, pdnscmd_audit_reverse")
+        db.execute("CREATE TEMPORARY TABLE pdnscmd_audit_forward (ip inet, name text); "
+                   "CREATE TEMPORARY TABLE pdnscmd_audit_reverse (ip inet, zone_id int, name text, ttl int, target text)")
+        for table, query, transform in (
+                ('pdnscmd_audit_forward', "SELECT name, content FROM records WHERE type IN ('A', 'AAAA')", forward),
+                ('pdnscmd_audit_reverse', "SELECT domain_id, name, ttl, content FROM records WHERE type = 'PTR'", reverse)):
+            sink = CopyTransform(transform)
+            db.copy_expert("COPY (%s) TO STDOUT" % query, sink)
+            db.copy_expert("COPY %s FROM STDIN" % table, sink.rewind())
+            sink.file.close()
+        db.execute("ANALYZE pdnscmd_audit_forward; ANALYZE pdnscmd_audit_reverse")
+
+        for row in iter_query("SELECT host(f.ip), array_agg(f.name ORDER BY f.name) FROM pdnscmd_audit_forward f "
+                              "WHERE NOT EXISTS (SELECT 1 FROM pdnscmd_audit_reverse r WHERE r.ip = f.ip) "
+                              "GROUP BY f.ip ORDER BY f.ip"):
+            yield ('missing', row[0], row[1], None, False)
+        for row in iter_query("SELECT host(r.ip), r.zone_id, d.name, r.name, r.ttl, r.target FROM pdnscmd_audit_reverse r "
+                              "JOIN domains d ON d.id = r.zone_id "
+                              "WHERE NOT EXISTS (SELECT 1 FROM pdnscmd_audit_forward f WHERE f.ip = r.ip) "
+                              "ORDER BY r.ip, r.name"):
+            yield ('dangling', row[0], [], row[1:], False)
+        for row in iter_query("SELECT host(r.ip), r.zone_id, d.name, r.name, r.ttl, r.target, array_agg(f.name ORDER BY f.name), "
+                              "EXISTS (SELECT 1 FROM pdnscmd_audit_reverse r2 JOIN pdnscmd_audit_forward f2 "
+                              "ON f2.ip = r2.ip AND f2.name = lower(rtrim(r2.target, '.')) WHERE r2.ip = r.ip) "
+                              "FROM pdnscmd_audit_reverse r JOIN domains d ON d.id = r.zone_id "
+                              "JOIN pdnscmd_audit_forward f ON f.ip = r.ip "
+                              "GROUP BY r.ip, r.zone_id, d.name, r.name, r.ttl, r.target "
+                              "HAVING NOT bool_or(f.name = lower(rtrim(r.target, '.'))) ORDER BY r.ip, r.name"):
+            yield ('mismatched', row[0], row[6], row[1:6], row[7])
+        db.execute("DROP TABLE pdnscmd_audit_forward, pdnscmd_audit_reverse")
+
+    def create_domain(self, name):
+        return self.create_domains([name], DomainTemplate())[name]
+
+    def create_domains(self, names, template):
+        """Insert domains with one statement and their template records with COPY"""
+        db.execute("INSERT INTO domains (name, last_check, notified_serial, type, master, account) "
+                   "SELECT unnest(%s::text[]), NULL, 0, 'MASTER', %s, '' RETURNING name, id", (list(names), MASTER_DNS))
+        ids = dict(db.fetchall())
+        rows = ((ids[name], key, rtype, content, ttl, prio)
+                for name in names for key, rtype, ttl, prio, content in template.rows(name))
+        db.copy_expert("COPY records (domain_id, name, type, content, ttl, prio) FROM STDIN", CopyStream(rows))
+        return ids
+
+    def delete_domain(self, domain):
+        self.delete_domains([domain])
+
+    def delete_domains(self, domains):
+        zone_ids = [d.zone_id for d in domains]
+        execute_prepared('delete_zone_records', "DELETE FROM records WHERE domain_id = ANY(%s::int[])", (zone_ids,), queue=True)
+        execute_prepared('delete_zones', "DELETE FROM domains WHERE id = ANY(%s::int[])", (zone_ids,), queue=True)
+
+    def session_pids(self):
+        """Backend pids of the connections of this session"""
+        if dbconn.connected:
+            self.pids.add(dbconn.get_backend_pid())
+        return self.pids
+
+    @property
+    def conflicts(self):
+        """Errors after which the transaction can be retried"""
+        import psycopg2.extensions
+        return (psycopg2.extensions.TransactionRollbackError,)
+
+    def connection_pool(self, size):
+        if self.pool is None or self.pool.maxconn < size:
+            from psycopg2.pool import ThreadedConnectionPool
+            if self.pool is not None:
+                self.pool.closeall()
+            self.pool = ThreadedConnectionPool(0, size, dsn(), cursor_factory=instrumented_cursor())
+        return self.pool
+
+    def apply_shard(self, tasks, bump):
+        """Apply tasks and bump serials of their zones on this thread's connection"""
+        self.lock_zones(task_zone_ids(tasks))
+        results = CommitEngine().run(tasks)
+        Rectifier().run(tasks)
+        if bump:
+            inc_serials(list(OrderedDict.fromkeys([t.domain for t in tasks])))
+        return results
+
+    def apply_parallel(self, shards, workers, per_zone=False, bump=True):
+        """Apply zone shards on a pool of connections, return list of (task, success)
+
+        By default the zones are spread over workers connections, each
+        applies its share in a two-phase commit transaction that is
+        prepared here and committed or rolled back together with the
+        session by commit and rollback. This needs max_prepared_transactions
+        on the server. With per_zone every zone is committed on its own as
+        soon as it is applied, a failing zone does not stop the others.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        pool = self.connection_pool(workers)
+        if per_zone:
+            jobs = list(shards.items())
+            run = lambda job: self.apply_zone(pool, job[0], job[1], bump)
+        else:
+            jobs = [[] for i in range(min(workers, len(shards)))]
+            for zone_tasks in sorted(shards.values(), key=len, reverse=True):
+                min(jobs, key=len).extend(zone_tasks)
+            gtrid = 'pdnscmd-%d-%d' % (os.getpid(), int(time.time() * 1000))
+            run = lambda job: self.apply_prepared(pool, '%s-%d' % (gtrid, id(job)), job, bump)
+        done = {}
+        with ThreadPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+            futures = [executor.submit(run, job) for job in jobs]
+            try:
+                for future in futures:
+                    for t, success in future.result():
+                        done[id(t)] = success
+            except Exception:
+                for future in futures:
+                    future.exception()
+                self.rollback_prepared()
+                raise
+        return [(t, done[id(t)]) for zone_tasks in shards.values() for t in zone_tasks]
+
+    def apply_prepared(self, pool, xid, tasks, bump):
+        conn = pool.getconn()
+        self.pids.add(conn.get_backend_pid())
+        try:
+            conn.tpc_begin(conn.xid(0, xid, 'pdnscmd'))
+            with thread_connection(conn):
+                results = self.apply_shard(tasks, bump)
+                db.flush()
+            conn.tpc_prepare()
+        except Exception:
+            conn.tpc_rollback()
+            pool.putconn(conn)
+            raise
+        with self.prepared_lock:
+            self.prepared.append(conn)
+        return results
+
+    def apply_zone(self, pool, zone_id, tasks, bump):
+        conn = pool.getconn()
+        self.pids.add(conn.get_backend_pid())
+        attempt = 0
+        try:
+            with thread_connection(conn):
+                while True:
+                    try:
+                        results = self.apply_shard(tasks, bump)
+                        db.flush()
+                        conn.commit()
+                        return results
+                    except self.conflicts:
+                        conn.rollback()
+                        attempt += 1
+                        if attempt > COMMIT_RETRIES:
+                            raise
+                        stats.retries += 1
+                        time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+        except self.errors as e:
+            conn.rollback()
+            print("Zone %s failed: %s" % (tasks[0].domain.domain, str(e).strip()))
+            return [(t, False) for t in tasks]
+        finally:
+            pool.putconn(conn)
+
+    def rollback_prepared(self):
+        with self.prepared_lock:
+            for conn in self.prepared:
+                conn.tpc_rollback()
+                self.pool.putconn(conn)
+            self.prepared = []
+
+    def lock_zones(self, zone_ids):
+        """Take transaction advisory locks of zones in id order
+
+        Commits to the same zone queue up here, commits to different
+        zones do not wait for each other. Locks are released on commit
+        or rollback. The statement is sent with the first change.
+        """
+        if zone_ids:
+            execute_prepared('lock_zones', "SELECT count(pg_advisory_xact_lock(%s::int, id)) FROM "
+                             "(SELECT id FROM unnest(%s::int[]) AS id ORDER BY id) AS z",
+                             (ZONE_LOCK_CLASS, list(zone_ids)), queue=True)
+
+    def apply(self, tasks):
+        results = CommitEngine().run(tasks)
+        Rectifier().run(tasks)
+        return results
+
+    def bump_serials(self, domains):
+        inc_serials(domains)
+
+    def notify(self, zone):
+        """Notify through the PowerDNS HTTP API of the [api] section"""
+        if self.api is None:
+            self.api = ApiBackend()
+        self.api.notify(zone)
+
+    def flush(self):
+        """Send queued statements, their errors are raised here"""
+        db.flush()
+
+    def commit(self):
+        db.flush()
+        # prepared transactions are all committed or left for rollback
+        with self.prepared_lock:
+            for conn in self.prepared:
+                conn.tpc_commit()
+            for conn in self.prepared:
+                self.pool.putconn(conn)
+            self.prepared = []
+        dbconn.commit()
+
+    def rollback(self):
+        self.rollback_prepared()
+        if dbconn.connected:
+            db.discard()
+            dbconn.rollback()
+
+
+class ApiBackend(object):
+    """Changes sent to the PowerDNS HTTP API
+
+    PowerDNS takes care of rectify, caches and serials (SOA-EDIT-API).
+    Uses one keep-alive session and sends all queued record changes of a
+    zone as one PATCH of its rrsets. There are no transactions, commit
+    and rollback do nothing.
+    """
+
+    name = 'api'
+
+    def __init__(self, url=None, key=None, server_id=None, timeout=None):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.url = '%s/api/v1/servers/%s' % ((url or API_URL).rstrip('/'), server_id or API_SERVER_ID)
+        self.timeout = timeout or API_TIMEOUT
+        for name in ['urllib3', 'charset_normalizer']:
+            logging.getLogger(name).setLevel(logging.WARNING)
+        self.session = requests.Session()
+        self.session.headers['X-API-Key'] = key if key is not None else API_KEY
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(NOTIFY_WORKERS, 1))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.errors = (requests.RequestException, CommandException)
+        # zone id -> {(name, type): rrset} as last seen on the server
+        self.rrsets = {}
+        self.ids = {}
+
+    def request(self, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            r = self.session.request(method, self.url + path, timeout=self.timeout, **kwargs)
+        finally:
+            stats.query('%s %s' % (method, re.sub(r'/zones/[^/]+', '/zones/?', path)), time.perf_counter() - start)
+        if r.status_code >= 400:
+            try:
+                error = r.json().get('error', r.text)
+            except ValueError:
+                error = r.text
+            raise CommandException("API %s %s failed: %s %s" % (method, path, r.status_code, error))
+        if not r.content:
+            return None
+        return r.json()
+
+    def absolute(self, name):
+        return name.rstrip('.') + '.'
+
+    def to_api(self, rtype, content, prio=None):
+        """records table content to API rrset content"""
+        if rtype in ZONE_NAME_TYPES:
+            content = self.absolute(content)
+        elif rtype in ['MX', 'SRV']:
+            parts = content.split()
+            content = ' '.join(parts[:-1] + [self.absolute(parts[-1])])
+            if prio is not None:
+                content = '%s %s' % (prio, content)
+        return content
+
+    def from_api(self, rtype, content):
+        """API rrset content to records table (prio, content)"""
+        if rtype in ['MX', 'SRV']:
+            prio, content = content.split(None, 1)
+            return int(prio), content.rstrip('.')
+        if rtype in ZONE_NAME_TYPES:
+            return None, content.rstrip('.')
+        return None, content
+
+    def zones(self):
+        return self.request('GET', '/zones')
+
+    def zone_id(self, name):
+        for zone in self.request('GET', '/zones', params={'zone': self.absolute(name)}):
+            self.ids[name] = zone['id']
+            return zone['id']
+        return None
+
+    def zone_names(self):
+        return [x['name'].rstrip('.') for x in self.zones()]
+
+    def zone_ids(self, names):
+        names = set(names)
+        return dict([(x['name'].rstrip('.'), x['id']) for x in self.zones() if x['name'].rstrip('.') in names])
+
+    def existing(self, records):
+        """Same as SqlBackend.existing, from the zones' rrsets"""
+        found = []
+        for t in records:
+            rrset = self.zone_rrsets(t.domain).get((t.key, t.rtype)) if t.domain.zone_id is not None else None
+            rows = [self.from_api(t.rtype, x['content']) for x in (rrset or {}).get('records', [])]
+            value = t.value.rstrip('.') if t.rtype in ZONE_NAME_TYPES + ['MX', 'SRV'] else t.value
+            found.append(any(content == value and (t.priority is None or prio == t.priority) for prio, content in rows)
+                         and (t.action == RecordActions.ADD or t.ttl is None or rrset['ttl'] == t.ttl))
+        return found
+
+    def contents(self, records):
+        """Same as SqlBackend.contents, from the zones' rrsets"""
+        result = {}
+        for t in records:
+            rrset = self.zone_rrsets(t.domain).get((t.key, t.rtype)) if t.domain.zone_id is not None else None
+            for record in (rrset or {}).get('records', []):
+                prio, content = self.from_api(t.rtype, record['content'])
+                result.setdefault((t.domain.zone_id, t.key, t.rtype), set()).add(content)
+        return result
+
+    def match_zones(self, patterns):
+        from fnmatch import fnmatchcase
+        return dict([(x['name'].rstrip('.'), x['id']) for x in self.zones()
+                     if any(fnmatchcase(x['name'].rstrip('.'), p) for p in patterns)])
+
+    def dangling_ptrs(self, zone_ids):
+        """Same as SqlBackend.dangling_ptrs, reads the reverse zones"""
+        zones = dict([(x['id'], x['name'].rstrip('.')) for x in self.zones()])
+        names = set()
+        for zone_id in zone_ids:
+            names.update([k[0] for k in self.zone_rrsets(Domain(zones[zone_id], zone_id=zone_id))])
+        rows = []
+        for zone_id, zone in zones.items():
+            if zone_id in zone_ids or not zone.endswith('.arpa'):
+                continue
+            for (name, rtype), rrset in self.zone_rrsets(Domain(zone, zone_id=zone_id)).items():
+                for r in rrset['records'] if rtype == 'PTR' else []:
+                    if r['content'].rstrip('.') in names:
+                        rows.append((zone, zone_id, name, rrset['ttl'], r['content']))
+        return rows
+
+    def iter_domains(self):
+        for zone in sorted(self.zones(), key=lambda x: x['name']):
+            yield zone['name'].rstrip('.'), zone['kind'].upper(), zone.get('notified_serial')
+
+    def zone_rrsets(self, domain, reload=False):
+        if reload or domain.zone_id not in self.rrsets:
+            zone = self.request('GET', '/zones/%s' % domain.zone_id)
+            self.rrsets[domain.zone_id] = dict([((x['name'].rstrip('.'), x['type']), x) for x in zone['rrsets']])
+        return self.rrsets[domain.zone_id]
+
+    def iter_records(self, domain, keywords=(), limit=None, offset=0):
+        rows = []
+        for (name, rtype), rrset in self.zone_rrsets(domain, reload=True).items():
+            for record in rrset['records']:
+                prio, content = self.from_api(rtype, record['content'])
+                rows.append((name, rtype, rrset['ttl'], prio, content))
+        rows = sorted([x for x in rows if not keywords or row_matches(x, keywords)], key=lambda x: (x[0], x[1], x[4]))
+        return islice(rows, offset, None if limit is None else offset + limit)
+
+    def create_domain(self, name):
+        return self.create_domains([name], DomainTemplate())[name]
+
+    def create_domains(self, names, template):
+        """POST every zone with its template records, PowerDNS makes the SOA"""
+        ids = {}
+        for name in names:
+            rrsets = OrderedDict()
+            for key, rtype, ttl, prio, content in template.rows(name):
+                if rtype == 'SOA' or (rtype == 'NS' and key == name):
+                    continue
+                rrset = rrsets.setdefault((key, rtype), {'name': self.absolute(key), 'type': rtype,
+                                                         'ttl': ttl, 'records': []})
+                rrset['records'].append({'content': self.to_api(rtype, content, prio), 'disabled': False})
+            zone = self.request('POST', '/zones', json={
+                'name': self.absolute(name),
+                'kind': 'Master',
+                'nameservers': [self.absolute(x) for x in template.nameservers],
+                'soa_edit_api': 'DEFAULT',
+                'rrsets': list(rrsets.values()),
+            })
+            self.ids[name] = ids[name] = zone['id']
+        return ids
+
+    def delete_domain(self, domain):
+        self.request('DELETE', '/zones/%s' % domain.zone_id)
+        self.rrsets.pop(domain.zone_id, None)
+        self.ids.pop(domain.domain, None)
+
+    def delete_domains(self, domains):
+        for domain in domains:
+            self.delete_domain(domain)
+
+    def patch(self, domain, records):
+        """Apply record tasks of one zone with one PATCH, return success per task
+
+        The zone is fetched again first, REPLACE would drop records others
+        added since it was loaded.
+        """
+        current = self.zone_rrsets(domain, reload=True)
+        changed = OrderedDict()
+        ok = []
+        for r in records:
+            key = (r.key, r.rtype)
+            if key not in changed:
+                rrset = current.get(key, {'name': self.absolute(r.key), 'type': r.rtype,
+                                          'ttl': r.ttl or DEFAULT_TTL, 'records': []})
+                changed[key] = dict(rrset, records=list(rrset['records']))
+            rrset = changed[key]
+            content = self.to_api(r.rtype, r.value, r.priority)
+            if r.action == RecordActions.DELETE:
+                before = len(rrset['records'])
+                rrset['records'] = [x for x in rrset['records'] if x['content'] != content]
+                ok.append(len(rrset['records']) < before)
+            else:
+                if r.ttl:
+                    rrset['ttl'] = r.ttl
+                if content not in [x['content'] for x in rrset['records']]:
+                    rrset['records'].append({'content': content, 'disabled': False})
+                ok.append(True)
+        body = []
+        for rrset in changed.values():
+            if rrset['records']:
+                body.append({'name': rrset['name'], 'type': rrset['type'], 'ttl': rrset['ttl'],
+                             'changetype': 'REPLACE', 'records': rrset['records']})
+            else:
+                body.append({'name': rrset['name'], 'type': rrset['type'], 'changetype': 'DELETE'})
+        if body:
+            self.request('PATCH', '/zones/%s' % domain.zone_id, json={'rrsets': body})
+        for key, rrset in changed.items():
+            if rrset['records']:
+                current[key] = rrset
+            else:
+                current.pop(key, None)
+        return ok
+
+    def apply(self, tasks):
+        """Execute tasks, return list of (task, success) in queue order"""
+        done = {}
+        pending = OrderedDict()
+
+        def flush(name):
+            domain, records = pending.pop(name)
+            for r, success in zip(records, self.patch(domain, records)):
+                done[id(r)] = success
+
+        for t in tasks:
+            if isinstance(t, Record):
+                pending.setdefault(t.domain.domain, (t.domain, []))[1].append(t)
+            else:
+                # Only changes to the same zone have to go before domain tasks
+                if t.domain in pending:
+                    flush(t.domain)
+                done[id(t)] = t.execute() is not False
+        for name in list(pending):
+            flush(name)
+        return [(t, done[id(t)]) for t in tasks]
+
+    # The API has no transactions to retry or lock
+    conflicts = ()
+    parallel = False
+
+    def lock_zones(self, zone_ids):
+        pass
+
+    def bump_serials(self, domains):
+        # PowerDNS increases the serial according to SOA-EDIT-API
+        pass
+
+    def flush(self):
+        pass
+
+    def notify(self, zone):
+        zone_id = self.ids.get(zone) or self.zone_id(zone)
+        if zone_id is None:
+            raise CommandException("No such zone %s" % zone)
+        self.request('PUT', '/zones/%s/notify' % zone_id)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+BACKENDS = {
+    'gpgsql': SqlBackend,
+    'api': ApiBackend,
+}
+
+current_backend = None
+
+def backend():
+    """Configured backend, created on first use"""
+    global current_backend
+    if current_backend is None:
+        if BACKEND not in BACKENDS:
+            raise CommandException("Invalid backend %s" % BACKEND)
+        current_backend = BACKENDS[BACKEND]()
+    return current_backend
+
+
+def check_content(rtype, value):
+    """Raise CommandException if value is not valid content for rtype"""
+    if rtype == "A":
+        try:
+            IPv4Address(value)
+        except AddressValueError as e:
+            raise CommandException("Invalid IPv4 address: %s" % e)
+    if rtype == "AAAA":
+        try:
+            IPv6Address(value)
+        except AddressValueError as e:
+            raise CommandException("Invalid IPv6 address: %s" % e)
+
+
+def reverse_name(ip):
+    """Reverse lookup name for IPv4 or IPv6 address"""
+    if ':' in ip:
+        try:
+            ipobject = IPv6Address(ip)
+        except AddressValueError as e:
+            raise CommandException("Invalid IPv6 address: %s" % e)
+        return '.'.join(ipobject.exploded[::-1].replace(':', '')) + '.ip6.arpa'
+    try:
+        ipobject = IPv4Address(ip)
+    except AddressValueError as e:
+        raise CommandException("Invalid IPv4 address: %s" % e)
+    return '.'.join(ipobject.exploded.split('.')[::-1]) + '.in-addr.arpa'
+
+
+def reverse_ip(name):
+    """Address of reverse lookup name, None if name is not one"""
+    name = name.lower().rstrip('.')
+    try:
+        if name.endswith('.in-addr.arpa'):
+            labels = name[:-len('.in-addr.arpa')].split('.')
+            if len(labels) == 4:
+                return str(IPv4Address('.'.join(labels[::-1])))
+        elif name.endswith('.ip6.arpa'):
+            labels = name[:-len('.ip6.arpa')].split('.')
+            if len(labels) == 32 and all([len(x) == 1 for x in labels]):
+                nibbles = ''.join(labels[::-1])
+                return str(IPv6Address(':'.join([nibbles[i:i + 4] for i in range(0, 32, 4)])))
+    except AddressValueError:
+        pass
+    return None
+
+
+def parse_ip(text):
+    """Normalized address, None if text is not one"""
+    try:
+        return str(ip_address(text))
+    except ValueError:
+        return None
+
+
+MAX_GENREV = 1 << 18
+
+
+def parse_network(cidr):
+    try:
+        if ':' in cidr:
+            return IPv6Network(cidr, strict=False)
+        return IPv4Network(cidr, strict=False)
+    except ValueError as e:
+        raise CommandException("Invalid network %s: %s" % (cidr, e))
+
+
+def ip_in_network(ip, network):
+    try:
+        if network.version == 6:
+            return IPv6Address(ip) in network
+        return IPv4Address(ip) in network
+    except ValueError:
+        return False
+
+
+class ZoneIndex(object):
+    """Zone names as label reversed trie and sorted list
+
+    Finds the most specific zone for a name in O(labels) and completes
+    name prefixes with binary search.
+    """
+
+    def __init__(self, names=()):
+        self._root = None
+        self.loaded = time.time()
+        self.names = sorted(set([x.lower().rstrip('.') for x in names]))
+
+    @property
+    def root(self):
+        # Trie is only built when reverse zones are looked up
+        if self._root is None:
+            self._root = {}
+            for name in self.names:
+                self.add_label_path(name)
+        return self._root
+
+    def labels(self, name):
+        return reversed(name.lower().rstrip('.').split('.'))
+
+    def add_label_path(self, name):
+        node = self.root
+        for label in self.labels(name):
+            node = node.setdefault(label, {})
+        node[None] = name
+
+    def add(self, name):
+        name = name.lower().rstrip('.')
+        i = bisect_left(self.names, name)
+        if i == len(self.names) or self.names[i] != name:
+            self.names.insert(i, name)
+        if self._root is not None:
+            self.add_label_path(name)
+
+    def remove(self, name):
+        name = name.lower().rstrip('.')
+        i = bisect_left(self.names, name)
+        if i < len(self.names) and self.names[i] == name:
+            del self.names[i]
+        if self._root is None:
+            return
+        path = [self.root]
+        for label in self.labels(name):
+            node = path[-1].get(label)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].pop(None, None)
+        # Prune branches left empty
+        for label, parent, node in zip(list(self.labels(name))[::-1], path[-2::-1], path[:0:-1]):
+            if node:
+                break
+            del parent[label]
+
+    def longest_match(self, name):
+        node = self.root
+        found = None
+        for label in self.labels(name):
+            node = node.get(label)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
+
+    def complete(self, prefix, limit=20):
+        """Names starting with prefix
+
+        With more than limit matches complete only up to the end of the
+        next label, and if that is still too many, to the longest common
+        prefix.
+        """
+        start = bisect_left(self.names, prefix)
+        end = bisect_left(self.names, prefix + '\uffff', start)
+        if end - start <= limit:
+            return self.names[start:end]
+        candidates = []
+        i = start
+        while i < end:
+            dot = self.names[i].find('.', len(prefix))
+            if dot < 0:
+                candidates.append(self.names[i])
+                i += 1
+                continue
+            candidates.append(self.names[i][:dot + 1])
+            if len(candidates) > limit:
+                common = os.path.commonprefix([self.names[start], self.names[end - 1]])
+                return [common] if len(common) > len(prefix) else []
+            # Skip the rest of names below this label
+            i = bisect_left(self.names, candidates[-1] + '\uffff', i, end)
+        return candidates
+
+
+def like_pattern(text):
+    """LIKE pattern matching text as substring"""
+    return '%%%s%%' % text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def like_suffix(name):
+    """LIKE pattern matching names below name"""
+    return '%%.%s' % name.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def glob_like(pattern):
+    """LIKE pattern for shell style pattern with * and ?"""
+    pattern = pattern.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return pattern.replace('*', '%').replace('?', '_')
+
+
+def row_matches(row, keywords):
+    """(name, type, ttl, prio, content) row matches any of keywords like search_records"""
+    return any(k in (row[0] or '') or k.upper() == row[1] or k in (row[4] or '') for k in keywords)
+
+
+def pop_option(args, option):
+    """Remove option and its value from args list, return value"""
+    if option not in args:
+        return None
+    i = args.index(option)
+    if i + 1 >= len(args):
+        raise CommandException("%s requires a value" % option)
+    value = args[i + 1]
+    del args[i:i + 2]
+    return value
+
+
+def pop_int_option(args, option):
+    """Remove option and its integer value from args list, return value"""
+    if option not in args:
+        return None
+    i = args.index(option)
+    try:
+        value = int(args[i + 1])
+    except (IndexError, ValueError):
+        raise CommandException("%s requires a number" % option)
+    if value < 0:
+        raise CommandException("%s requires a positive number" % option)
+    del args[i:i + 2]
+    return value
+
+
+def bind_line(origin, row):
+    """Format (name, type, ttl, prio, content) row as zone file line"""
+    name, rtype, ttl, prio, content = row
+
+    def absolute(value):
+        return value.rstrip('.') + '.'
+
+    if name == origin:
+        owner = '@'
+    elif name.endswith('.' + origin):
+        owner = name[:-len(origin) - 1]
+    else:
+        owner = absolute(name)
+    if rtype in ZONE_NAME_TYPES or rtype in ['MX']:
+        content = absolute(content)
+    elif rtype == 'SRV' and len(content.split()) == 3:
+        weight, port, target = content.split()
+        content = '%s %s %s' % (weight, port, absolute(target))
+    elif rtype == 'SOA' and len(content.split()) == 7:
+        parts = content.split()
+        content = ' '.join([absolute(parts[0]), absolute(parts[1])] + parts[2:])
+    if prio is not None and rtype in ['MX', 'SRV']:
+        content = '%s %s' % (prio, content)
+    return "%s\t%s\tIN\t%s\t%s" % (owner, ttl if ttl is not None else DEFAULT_TTL, rtype, content)
+
+
+VALIDATION_ERRORS = {
+    'exists': "Record already exists",
+    'missing': "Record does not exist",
+    'duplicate': "Same change queued twice",
+    'reverse': "Reverse record already exists with another value",
+}
+
+
+def check_reverses(records):
+    """Check PTR tasks queued with reverse against the stored PTRs
+
+    Their content is changed to the stored spelling with or without the
+    trailing dot, so existence checks and deletes match it. Returns the
+    adds for names that already point elsewhere.
+    """
+    reverses = [t for t in records if t.reverse]
+    if not reverses:
+        return []
+    stored = backend().contents(reverses)
+    ptrs = {}
+    for t in reverses:
+        key = (t.domain.zone_id, t.key, 'PTR')
+        ptrs[key] = set(stored.get(key, ()))
+    conflicts = []
+    # replay in queue order, earlier deletes free the name
+    for t in records:
+        current = ptrs.get((t.domain.zone_id, t.key, t.rtype))
+        if current is None:
+            continue
+        same = [x for x in current if x.rstrip('.') == t.value.rstrip('.')]
+        if t.reverse and same:
+            t.value = same[0]
+        if t.action == RecordActions.DELETE:
+            current.discard(t.value)
+            continue
+        if t.reverse and [x for x in current if x not in same]:
+            conflicts.append(t)
+        current.add(t.value)
+    return conflicts
+
+
+def validate_tasks(tasks):
+    """Check queued record tasks against the database and each other
+
+    Existence of all records is looked up with backend().existing in one
+    go, then the queue is replayed in order so a delete after an add of
+    the same record is fine. Generated reverse records are checked with
+    check_reverses first. Returns list of (task, problem) with problem a
+    VALIDATION_ERRORS key, and the optional tasks that would fail.
+    """
+    records = [t for t in tasks if isinstance(t, Record)]
+    conflicts = check_reverses(records)
+    found = backend().existing(records) if records else []
+    # like do_delete, MX and SRV may be stored with the priority in content
+    retry = [i for i, t in enumerate(records) if not found[i] and t.action == RecordActions.DELETE
+             and t.rtype in ['MX', 'SRV'] and t.priority is not None]
+    if retry:
+        alternatives = []
+        for i in retry:
+            alternative = copy.copy(records[i])
+            alternative.value = '%s %s' % (alternative.priority, alternative.value)
+            alternative.priority = None
+            alternatives.append(alternative)
+        for i, alternative, exists in zip(retry, alternatives, backend().existing(alternatives)):
+            if exists:
+                records[i].value = alternative.value
+                records[i].priority = None
+                found[i] = True
+    state = {}
+    problems = [(t, 'reverse') for t in conflicts]
+    conflicts = set([id(t) for t in conflicts])
+    skipped = []
+    for t, exists in zip(records, found):
+        if id(t) in conflicts:
+            continue
+        key = (t.domain.domain, t.key, t.rtype, t.value, t.priority)
+        present = state.get(key, exists)
+        if (t.action == RecordActions.ADD) != present:
+            state[key] = t.action == RecordActions.ADD
+            continue
+        if t.optional:
+            skipped.append(t)
+        elif key in state:
+            problems.append((t, 'duplicate'))
+        else:
+            problems.append((t, 'exists' if present else 'missing'))
+    return problems, skipped
+
+
+class CommitEngine(object):
+    """Apply queued tasks with as few statements as possible
+
+    Consecutive records with the same action are grouped by zone and
+    column set and sent as one multi-row INSERT or DELETE of arrays,
+    prepared once per column set. Other tasks (domains) are executed one
+    by one in queue order.
+    """
+
+    PAGE_SIZE = 1000
+
+    CASTS = {
+        'name': '%s::text[]',
+        'type': '%s::text[]',
+        'content': '%s::text[]',
+        'domain_id': '%s::int[]',
+        'ttl': '%s::int[]',
+        'prio': '%s::int[]',
+    }
+
+    def run(self, tasks):
+        """Execute tasks, return list of (task, success) in queue order"""
+        results = []
+        batch = []
+        for t in tasks:
+            if isinstance(t, Record) and (not batch or batch[-1].action == t.action):
+                batch.append(t)
+                continue
+            results.extend(self.flush(batch))
+            batch = []
+            if isinstance(t, Record):
+                batch.append(t)
+            else:
+                results.append((t, t.execute() is not False))
+        results.extend(self.flush(batch))
+        return results
+
+    def flush(self, batch):
+        groups = {}
+        for t in batch:
+            args, values = t.columns()
+            groups.setdefault((t.domain.zone_id, tuple(args)), []).append((t, values))
+        done = {}
+        for (zone_id, args), items in groups.items():
+            if batch[0].action == RecordActions.DELETE:
+                ok = self.delete(args, [x[1] for x in items])
+            elif batch[0].action == RecordActions.ADD:
+                ok = self.insert(args, [x[1] for x in items])
+            else:
+                raise NotImplementedError("Update not implemented")
+            for (t, values), success in zip(items, ok):
+                done[id(t)] = success
+        return [(t, done[id(t)]) for t in batch]
+
+    def pages(self, name, query, columns):
+        """Execute prepared query with a page of each column, yield result rows"""
+        for start in range(0, len(columns[0]), self.PAGE_SIZE):
+            execute_prepared(name, query, [x[start:start + self.PAGE_SIZE] for x in columns])
+            for row in db.fetchall():
+                yield row
+
+    def insert(self, args, rows):
+        query = ("INSERT INTO records (" + ', '.join(args) + ") SELECT * FROM unnest(" +
+                 ', '.join([self.CASTS[k] for k in args]) + ") RETURNING id")
+        ids = list(self.pages('records_insert_' + '_'.join(args), query, [list(x) for x in zip(*rows)]))
+        if DEBUG:
+            print("INSERT %d records (%s)" % (len(rows), ', '.join(args)))
+        return [True] * len(ids) + [False] * (len(rows) - len(ids))
+
+    def delete(self, args, rows):
+        where = ' and '.join(["r.%s = v.%s" % (k, k) for k in args])
+        query = ("DELETE FROM records r USING unnest(%s::int[], " + ', '.join([self.CASTS[k] for k in args]) + ") "
+                 "AS v (idx, " + ', '.join(args) + ") WHERE " + where + " RETURNING v.idx")
+        columns = [list(range(len(rows)))] + [list(x) for x in zip(*rows)]
+        deleted = set([x[0] for x in self.pages('records_delete_' + '_'.join(args), query, columns)])
+        if DEBUG:
+            print("DELETE %d records (%s)" % (len(rows), ', '.join(args)))
+        return [i in deleted for i in range(len(rows))]
+
+
+BASE32HEX = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ234567', '0123456789abcdefghijklmnopqrstuv')
+
+
+def nsec3_hash(name, salt, iterations):
+    """NSEC3 hash of name (RFC 5155) in lowercase base32hex
+
+    salt is hex as in NSEC3PARAM, - for none.
+    """
+    wire = b''.join([struct.pack('B', len(x)) + x for x in name.lower().encode('ascii').split(b'.') if x]) + b'\0'
+    salt = b'' if salt == '-' else bytes.fromhex(salt)
+    digest = hashlib.sha1(wire + salt).digest()
+    for i in range(iterations):
+        digest = hashlib.sha1(digest + salt).digest()
+    return base64.b32encode(digest).decode('ascii').translate(BASE32HEX)
+
+
+class Rectifier(object):
+    """Maintain ordername, auth and empty non-terminals of signed zones
+
+    Only the names queued records touched are updated, together with
+    their ancestors and the names below delegations that were added or
+    removed, so the cost follows the change and not the zone size.
+    Zone imports rectify their whole zone. Rules are the ones of
+    pdnsutil rectify-zone: names at or below a delegation are not
+    authoritative except DS at the delegation, glue A/AAAA and opt-out
+    NS get no ordername. Zones without cryptokeys and presigned zones
+    are left alone.
+    """
+
+    PAGE_SIZE = 10000
+
+    def run(self, tasks):
+        # zone id -> (names, delegations), None for the whole zone
+        touched = OrderedDict()
+        for t in tasks:
+            domain = getattr(t, 'domain', None)
+            if not isinstance(domain, Domain) or domain.zone_id is None:
+                continue
+            if isinstance(t, ZoneImport):
+                touched[domain.zone_id] = None
+            elif isinstance(t, Record) and touched.get(domain.zone_id, ()) is not None:
+                names, delegations = touched.setdefault(domain.zone_id, (set(), set()))
+                names.add(t.key)
+                if t.rtype == 'NS' and t.key != domain.domain:
+                    delegations.add(t.key)
+        if not touched:
+            return
+        execute_prepared('signed_zones',
+                         "SELECT d.id, d.name, (SELECT m.content FROM domainmetadata m "
+                         "WHERE m.domain_id = d.id AND m.kind = 'NSEC3PARAM' LIMIT 1), "
+                         "EXISTS (SELECT 1 FROM domainmetadata m WHERE m.domain_id = d.id "
+                         "AND m.kind = 'NSEC3NARROW' AND m.content = '1') "
+                         "FROM domains d WHERE d.id = ANY(%s::int[]) "
+                         "AND EXISTS (SELECT 1 FROM cryptokeys k WHERE k.domain_id = d.id) "
+                         "AND NOT EXISTS (SELECT 1 FROM domainmetadata m WHERE m.domain_id = d.id "
+                         "AND m.kind = 'PRESIGNED' AND m.content = '1')", (list(touched),))
+        for zone_id, zone, nsec3param, narrow in db.fetchall():
+            self.rectify(zone_id, zone, touched[zone_id], nsec3param, narrow)
+
+    def names_below(self, zone_id, names):
+        """Names with records at or below any of names"""
+        execute_prepared('rectify_below',
+                         "SELECT DISTINCT name FROM records WHERE domain_id = %s::int AND type IS NOT NULL "
+                         "AND (name = ANY(%s::text[]) OR name LIKE ANY(%s::text[]))",
+                         (zone_id, list(names), [like_suffix(x) for x in names]))
+        return set([x[0] for x in db.fetchall()])
+
+    def rectify(self, zone_id, zone, changes, nsec3param, narrow):
+        if changes is None:
+            names = self.names_below(zone_id, [zone])
+        else:
+            names, delegations = changes
+            if delegations:
+                names = names | self.names_below(zone_id, delegations)
+        names = set([x for x in names if x == zone or x.endswith('.' + zone)])
+        ancestors = set()
+        for name in names:
+            while name != zone:
+                name = name.split('.', 1)[1]
+                ancestors.add(name)
+        lookup = sorted(names | ancestors)
+        execute_prepared('rectify_types',
+                         "SELECT name, array_agg(DISTINCT coalesce(type, '')) FROM records "
+                         "WHERE domain_id = %s::int AND name = ANY(%s::text[]) GROUP BY name", (zone_id, lookup))
+        types = dict([(name, set(x)) for name, x in db.fetchall()])
+        delegation = set([x for x in lookup if x != zone and 'NS' in types.get(x, ())])
+
+        if nsec3param:
+            fields = nsec3param.split()
+            optout = int(fields[1]) & 1
+            ordername = lambda name: None if narrow else nsec3_hash(name, fields[3], int(fields[2]))
+        else:
+            optout = False
+            ordername = lambda name: ' '.join(reversed(name[:-len(zone) - 1].lower().split('.'))) if name != zone else ''
+
+        def authoritative(name):
+            while name != zone:
+                if name in delegation:
+                    return False
+                name = name.split('.', 1)[1]
+            return True
+
+        rows = []
+        ds, glue, optout_ns = [], [], []
+        for name in lookup:
+            real = types.get(name, set()) - set([''])
+            if not real:
+                continue
+            auth = authoritative(name)
+            rows.append((name, ordername(name), auth))
+            if not auth or name in delegation:
+                if 'DS' in real:
+                    ds.append(name)
+                glue.append(name)
+                if optout and name in delegation and 'DS' not in real:
+                    optout_ns.append(name)
+        for start in range(0, len(rows), self.PAGE_SIZE):
+            page = rows[start:start + self.PAGE_SIZE]
+            execute_prepared('rectify_names',
+                             "UPDATE records r SET ordername = v.ordername, auth = v.auth "
+                             "FROM unnest(%s::text[], %s::text[], %s::bool[]) AS v (name, ordername, auth) "
+                             "WHERE r.domain_id = %s::int AND r.name = v.name AND r.type IS NOT NULL",
+                             ([x[0] for x in page], [x[1] for x in page], [x[2] for x in page], zone_id), queue=True)
+        for name, names, query in (
+                ('rectify_ds', ds, "UPDATE records SET auth = true "
+                                   "WHERE domain_id = %s::int AND type = 'DS' AND name = ANY(%s::text[])"),
+                ('rectify_glue', glue, "UPDATE records SET ordername = NULL, auth = false "
+                                       "WHERE domain_id = %s::int AND type IN ('A', 'AAAA') AND name = ANY(%s::text[])"),
+                ('rectify_optout', optout_ns, "UPDATE records SET ordername = NULL, auth = false "
+                                              "WHERE domain_id = %s::int AND type = 'NS' AND name = ANY(%s::text[])")):
+            if names:
+                execute_prepared(name, query, (zone_id, names), queue=True)
+        self.empty_non_terminals(zone_id, zone, lookup, types, ordername, optout)
+
+    def empty_non_terminals(self, zone_id, zone, lookup, types, ordername, optout):
+        """Replace ENT rows of names without records that have records below
+
+        ENTs are authoritative if an authoritative name is below them,
+        read after the updates of the names are applied.
+        """
+        candidates = [x for x in lookup if x != zone and not types.get(x, set()) - set([''])]
+        stale = [x for x in lookup if '' in types.get(x, ())]
+        if not candidates and not stale:
+            return
+        execute_prepared('rectify_ents',
+                         "SELECT c.name, EXISTS (SELECT 1 FROM records r WHERE r.domain_id = %s::int "
+                         "AND r.type IS NOT NULL AND r.auth AND r.name LIKE c.pattern) "
+                         "FROM unnest(%s::text[], %s::text[]) AS c (name, pattern) WHERE EXISTS ("
+                         "SELECT 1 FROM records r WHERE r.domain_id = %s::int AND r.type IS NOT NULL "
+                         "AND r.name LIKE c.pattern)",
+                         (zone_id, candidates, [like_suffix(x) for x in candidates], zone_id))
+        ents = db.fetchall()
+        if stale:
+            execute_prepared('rectify_ent_delete',
+                             "DELETE FROM records WHERE domain_id = %s::int AND type IS NULL AND name = ANY(%s::text[])",
+                             (zone_id, stale), queue=True)
+        if ents:
+            execute_prepared('rectify_ent_insert',
+                             "INSERT INTO records (domain_id, name, type, ordername, auth) "
+                             "SELECT %s::int, v.name, NULL, v.ordername, v.auth "
+                             "FROM unnest(%s::text[], %s::text[], %s::bool[]) AS v (name, ordername, auth)",
+                             (zone_id, [name for name, auth in ents],
+                              [ordername(name) if auth or not optout else None for name, auth in ents],
+                              [auth for name, auth in ents]), queue=True)
+
+
+# Record types whose rdata holds domain names
+ZONE_NAME_TYPES = ['CNAME', 'NS', 'PTR', 'DNAME']
+ZONE_CLASSES = ['IN', 'CH', 'HS']
+TTL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_zone_ttl(value):
+    """Parse BIND style TTL like 3600 or 1h30m, return None if not a TTL"""
+    value = value.lower()
+    if value.isdigit():
+        return int(value)
+    ttl = 0
+    number = ''
+    for c in value:
+        if c.isdigit():
+            number += c
+        elif c in TTL_UNITS and number:
+            ttl += int(number) * TTL_UNITS[c]
+            number = ''
+        else:
+            return None
+    if number or not value[0].isdigit():
+        return None
+    return ttl
+
+
+def zone_tokens(line):
+    """Split zone file line into tokens, dropping comments
+
+    Quoted strings are kept with their quotes, parentheses are returned
+    as separate tokens.
+    """
+    tokens = []
+    token = ''
+    quoted = False
+    escaped = False
+    for c in line:
+        if quoted:
+            token += c
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == '"':
+                quoted = False
+        elif c == '"':
+            token += c
+            quoted = True
+        elif c == ';':
+            break
+        elif c in '()' or c.isspace():
+            if token:
+                tokens.append(token)
+                token = ''
+            if c in '()':
+                tokens.append(c)
+        else:
+            token += c
+    if quoted:
+        raise CommandException("Unterminated quoted string")
+    if token:
+        tokens.append(token)
+    return tokens
+
+
+def parse_zonefile(stream, origin, default_ttl=None):
+    """Parse RFC 1035 zone file from stream
+
+    Yields (name, type, ttl, prio, content) tuples in the form of the
+    records table: names are absolute without trailing dot, MX and SRV
+    priority is separated to prio. $ORIGIN, $TTL, relative names, omitted
+    owners and multi-line parentheses are supported.
+    """
+    origin = origin.rstrip('.').lower()
+    last_name = origin
+    last_ttl = default_ttl
+
+    def absolute(name):
+        if name == '@':
+            return origin
+        if name.endswith('.'):
+            return name[:-1].lower()
+        if not origin:
+            return name.lower()
+        return ('%s.%s' % (name, origin)).lower()
+
+    tokens = []
+    depth = 0
+    first = None
+    for lineno, line in enumerate(stream, 1):
+        try:
+            line_tokens = zone_tokens(line)
+        except CommandException as e:
+            raise CommandException("line %d: %s" % (lineno, e))
+        if depth == 0:
+            first = lineno
+            owner_omitted = line[:1].isspace()
+        for t in line_tokens:
+            if t == '(':
+                depth += 1
+            elif t == ')':
+                depth -= 1
+                if depth < 0:
+                    raise CommandException("line %d: unbalanced parentheses" % lineno)
+            else:
+                tokens.append(t)
+        if depth > 0 or not tokens:
+            continue
+        entry, tokens = tokens, []
+
+        if entry[0].startswith('$'):
+            directive = entry[0].upper()
+            if directive == '$ORIGIN' and len(entry) == 2:
+                origin = absolute(entry[1])
+            elif directive == '$TTL' and len(entry) == 2 and parse_zone_ttl(entry[1]) is not None:
+                default_ttl = parse_zone_ttl(entry[1])
+            else:
+                raise CommandException("line %d: unsupported directive %s" % (first, ' '.join(entry)))
+            continue
+
+        if not owner_omitted:
+            last_name = absolute(entry.pop(0))
+        ttl = None
+        while entry and (entry[0].upper() in ZONE_CLASSES or parse_zone_ttl(entry[0]) is not None):
+            value = entry.pop(0)
+            if value.upper() in ZONE_CLASSES:
+                if value.upper() != 'IN':
+                    raise CommandException("line %d: unsupported class %s" % (first, value))
+            else:
+                ttl = parse_zone_ttl(value)
+        if not entry:
+            raise CommandException("line %d: record type missing" % first)
+        rtype = entry.pop(0).upper()
+        if ttl is None:
+            ttl = default_ttl if default_ttl is not None else last_ttl
+        if ttl is None:
+            ttl = DEFAULT_TTL
+        last_ttl = ttl
+
+        prio = None
+        try:
+            if rtype in ZONE_NAME_TYPES:
+                content = absolute(entry[0])
+            elif rtype == 'MX':
+                prio = int(entry[0])
+                content = absolute(entry[1])
+            elif rtype == 'SRV':
+                prio = int(entry[0])
+                content = '%s %s %s' % (int(entry[1]), int(entry[2]), absolute(entry[3]))
+            elif rtype == 'SOA':
+                content = ' '.join([absolute(entry[0]), absolute(entry[1])] +
+                                   ['%s' % parse_zone_ttl(x) for x in entry[2:7]])
+                if len(entry) != 7:
+                    raise IndexError
+            else:
+                content = ' '.join(entry)
+                if not content:
+                    raise IndexError
+        except (IndexError, ValueError):
+            raise CommandException("line %d: invalid %s record" % (first, rtype))
+        yield (last_name, rtype, ttl, prio, content)
+    if depth:
+        raise CommandException("unbalanced parentheses at end of file")
+
+
+def copy_value(value):
+    """Format value for COPY text format"""
+    if value is None:
+        return '\\N'
+    return ('%s' % (value,)).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class CopyStream(object):
+    """File-like object feeding rows to COPY FROM STDIN as they are produced"""
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ''
+        self.count = 0
+
+    def read(self, size=-1):
+        lines = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                break
+            line = '\t'.join([copy_value(x) for x in row]) + '\n'
+            lines.append(line)
+            length += len(line)
+            self.count += 1
+        data = ''.join(lines)
+        if size < 0:
+            self.buffer = ''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+    readline = read
+
+
+class CopyTransform(object):
+    """File-like target of COPY TO STDOUT passing rows through transform
+
+    transform gets the fields of a row in COPY text format and returns
+    the fields to keep or None to drop the row. Kept rows are written to
+    a temporary file for a following COPY FROM.
+    """
+
+    def __init__(self, transform):
+        self.transform = transform
+        self.file = tempfile.TemporaryFile('w+')
+        self.buffer = ''
+        self.count = 0
+        self.dropped = 0
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            row = self.transform(line.split('\t'))
+            if row is None:
+                self.dropped += 1
+                continue
+            self.file.write('\t'.join(row) + '\n')
+            self.count += 1
+        return len(data)
+
+    def rewind(self):
+        self.file.seek(0)
+        return self.file
+
+
+class ZoneImport(Task):
+    """Bulk load zone file to existing or queued domain with COPY
+
+    SOA records and apex NS records already present are skipped, the
+    zone keeps the ones maintained by this tool. Rows are copied to a
+    temporary table first and only the ones not in the zone yet are
+    inserted, so importing the same file again adds nothing.
+    """
+
+    def __init__(self, filename, domain):
+        self.filename = filename
+        self.domain = domain
+        self.count = 0
+        self.skipped = 0
+
+    def rows(self, skip_ns=()):
+        with open(self.filename, 'r') as f:
+            for name, rtype, ttl, prio, content in parse_zonefile(f, self.domain.domain):
+                if name != self.domain.domain and not name.endswith('.' + self.domain.domain):
+                    raise CommandException("%s is not in zone %s" % (name, self.domain.domain))
+                if rtype == 'SOA':
+                    continue
+                if rtype == 'NS' and name == self.domain.domain and content in skip_ns:
+                    continue
+                try:
+                    check_content(rtype, content)
+                except CommandException as e:
+                    raise CommandException("%s %s: %s" % (name, rtype, e))
+                yield (self.domain.zone_id, name, rtype, content, ttl, prio)
+
+    def validate(self):
+        try:
+            self.count = sum(1 for x in self.rows())
+        except (IOError, OSError) as e:
+            raise CommandException("Cannot read %s: %s" % (self.filename, e))
+        return True
+
+    def execute(self):
+        execute_prepared('zone_ns', "SELECT content FROM records WHERE domain_id = %s::int and name = %s::text and type = 'NS'",
+                         (self.domain.zone_id, self.domain.domain))
+        stream = CopyStream(self.rows(skip_ns=set([x[0].rstrip('.') for x in db.fetchall()])))
+        db.execute("DROP TABLE IF EXISTS pdnscmd_import")
+        db.execute("CREATE TEMPORARY TABLE pdnscmd_import (domain_id int, name text, type text, content text, ttl int, prio int)")
+        db.copy_expert("COPY pdnscmd_import (domain_id, name, type, content, ttl, prio) FROM STDIN", stream)
+        db.execute("INSERT INTO records (domain_id, name, type, content, ttl, prio) "
+                   "SELECT DISTINCT ON (i.name, i.type, i.content, i.prio) i.domain_id, i.name, i.type, i.content, i.ttl, i.prio "
+                   "FROM pdnscmd_import i WHERE NOT EXISTS (SELECT 1 FROM records r WHERE r.domain_id = i.domain_id "
+                   "AND r.name = i.name AND r.type = i.type AND r.content = i.content AND r.prio IS NOT DISTINCT FROM i.prio)")
+        self.count = db.rowcount
+        self.skipped = stream.count - self.count
+        db.execute("DROP TABLE pdnscmd_import")
+        return True
+
+    def show(self):
+        show = "IMPORT %d records from %s to domain %s" % (self.count, self.filename, self.domain.domain)
+        if self.skipped:
+            show += ", %d already there" % self.skipped
+        return show
+
+
+class DomainTemplate(object):
+    """SOA, name servers and default records of new domains
+
+    soa is "primary contact refresh retry expire minimum", the serial is
+    added on creation. records are (key, type, ttl, prio, content) with
+    key relative to the domain or @, {domain} is replaced in key and
+    content.
+    """
+
+    def __init__(self, name='default', soa=None, nameservers=None, ttl=None, records=()):
+        self.name = name
+        self.soa = soa or '%s %s 3600 900 1209600 86400' % (MASTER_DNS, ADMIN_CONTACT)
+        if len(self.soa.split()) != 6:
+            raise CommandException("Invalid SOA in template %s: %s" % (name, self.soa))
+        self.nameservers = nameservers or [MASTER_DNS] + SLAVES
+        self.ttl = ttl or DEFAULT_TTL
+        self.records = list(records)
+
+    def rows(self, domain):
+        """(name, type, ttl, prio, content) rows of domain"""
+        primary, contact, timers = self.soa.split(None, 2)
+        yield (domain, 'SOA', self.ttl, 0, '%s %s %s01 %s' % (primary, contact, datetime.now().strftime("%Y%m%d"), timers))
+        for ns in self.nameservers:
+            yield (domain, 'NS', self.ttl, 0, ns)
+        for key, rtype, ttl, prio, content in self.records:
+            key = key.replace('{domain}', domain).rstrip('.')
+            if key in ['@', '']:
+                key = domain
+            elif key != domain and not key.endswith('.' + domain):
+                key = '%s.%s' % (key, domain)
+            yield (key, rtype, ttl or self.ttl, prio, content.replace('{domain}', domain))
+
+
+class DeleteDomains(Task):
+    """Delete domains and their records with one statement each"""
+
+    def __init__(self, domains):
+        self.deleted = domains
+        self.domain = None
+
+    def execute(self):
+        backend().delete_domains(self.deleted)
+        return True
+
+    def show(self):
+        names = [d.domain for d in self.deleted]
+        return "DELETE %d domains: %s%s" % (len(names), ', '.join(names[:5]), ', ...' if len(names) > 5 else '')
+
+
+class CreateDomains(Task):
+    """Create domains from a template in one go"""
+
+    def __init__(self, names, template):
+        self.names = names
+        self.template = template
+        self.domain = None
+        self.domains = []
 
-    def exists_record(self, key, rtype, value, priority=None):
-        key = self.fqdn(key)
-        query = "SELECT id from records WHERE domain_id = %s and name = %s and type = %s and content = %s"
-        args = [self.zone_id, key, rtype, value]
-        if priority is not None:
-            args.append("%s" % (priority,))
-            query = query + " and prio = %s"
-        if DEBUG:
-            print(query)
-        db.execute(query, args)
-        if db.fetchone() is None:
-            return False
+    def execute(self):
+        ids = backend().create_domains(self.names, self.template)
+        self.domains = [Domain(name, zone_id=ids[name]) for name in self.names]
         return True
 
-    def get_records(self, key, rtype=None, value=None):
-        key = self.fqdn(key)
-        args = [self.zone_id, key]
-        query = "SELECT name, type, ttl, coalesce(prio::text,''), content FROM records " \
-                "WHERE domain_id = %s and name = %s"
-        if rtype is not None:
-            query += " type = %s"
-            args.append(rtype)
-        if value is not None:
-            query += " content = %s"
-            args.append(value)
-        if DEBUG:
-            print(query)
-        db.execute(query, args)
-        return [self._format_record(x) for x in db.fetchall()]
+    def show(self):
+        return "ADD %d domains from template %s: %s%s" % (
+            len(self.names), self.template.name, ', '.join(self.names[:5]), ', ...' if len(self.names) > 5 else '')
 
-    """
-         Column      |          Type          |                      Modifiers                       | Storage  | Stats target | Description
-    -----------------+------------------------+------------------------------------------------------+----------+--------------+-------------
-     id              | integer                | not null default nextval('domains_id_seq'::regclass) | plain    |              |
-     name            | character varying(255) | not null                                             | extended |              |
-     master          | character varying(128) | default NULL::character varying                      | extended |              |
-     last_check      | integer                |                                                      | plain    |              |
-     type            | character varying(6)   | not null                                             | extended |              |
-     notified_serial | integer                |                                                      | plain    |              |
-     account         | character varying(40)  | default NULL::character varying                      | extended |              |
-    """
 
-    """
+def load_records_file(path):
+    """Load desired records from JSON or YAML file"""
+    try:
+        with open(path, 'r') as f:
+            if path.endswith('.yaml') or path.endswith('.yml'):
+                try:
+                    import yaml
+                except ImportError:
+                    raise CommandException("PyYAML is required to read %s" % path)
+                return yaml.safe_load(f)
+            return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        raise CommandException("Cannot read %s: %s" % (path, e))
 
-        Column    |           Type           |                      Modifiers                       | Storage  | Stats target | Description
-    --------------+--------------------------+------------------------------------------------------+----------+--------------+-------------
-      id          | integer                  | not null default nextval('records_id_seq'::regclass) | plain    |              |
-      domain_id   | integer                  |                                                      | plain    |              |
-      name        | character varying(255)   | default NULL::character varying                      | extended |              |
-      type        | character varying(10)    | default NULL::character varying                      | extended |              |
-      content     | character varying(65535) | default NULL::character varying                      | extended |              |
-      ttl         | integer                  |                                                      | plain    |              |
-      prio        | integer                  |                                                      | plain    |              |
-      change_date | integer                  |                                                      | plain    |              |
-      disabled    | boolean                  | default false                                        | plain    |              |
-      ordername   | character varying(255)   |                                                      | extended |              |
-      auth        | boolean                  | default true                                         | plain    |              |
 
-    """
+def iter_desired_zones(path, zone=None):
+    """Yield (zone, records) from a file or from a directory of zone files
 
-    def create(self):
-        if self.exists():
-            return
-        db.execute("INSERT INTO domains (name, last_check, notified_serial, type, master, account) VALUES (%s, NULL, 0, 'MASTER', %s, '') RETURNING id", (self.domain, MASTER_DNS))
-        res = db.fetchone()
-        self.zone_id = int(res[0])
-        db.execute("INSERT INTO records (name, type, ttl, content, prio, domain_id) VALUES (%s, 'SOA', %s, %s, %s, %s)" , (self.domain, DEFAULT_TTL, '%s %s %s01 3600 900 1209600 86400' % (MASTER_DNS, ADMIN_CONTACT, datetime.now().strftime("%Y%m%d")), '0', self.zone_id))
-        for i in [MASTER_DNS] + SLAVES:
-            db.execute("INSERT INTO records (name, type, ttl, content, prio, domain_id) VALUES (%s, 'NS', %s, %s, 0, %s)" , (self.domain, DEFAULT_TTL, i, self.zone_id))
+    A file holds a mapping of zone names to record lists, or a record
+    list for the zone given, and is loaded as a whole. In a directory
+    every file is one zone named after the file, zones are loaded one at
+    a time.
+    """
+    if os.path.isdir(path):
+        for filename in sorted(os.listdir(path)):
+            name, ext = os.path.splitext(filename)
+            if ext in ['.json', '.yaml', '.yml'] and (zone is None or name == zone):
+                yield name, load_records_file(os.path.join(path, filename))
+        return
+    data = load_records_file(path)
+    if isinstance(data, list):
+        if zone is None:
+            raise CommandException("Zone name required for record list in %s" % path)
+        yield zone, data
+    elif isinstance(data, dict):
+        for name in sorted(data):
+            if zone is None or name.rstrip('.') == zone:
+                yield name.rstrip('.'), data[name]
+    else:
+        raise CommandException("Invalid records file %s" % path)
 
-    def inc_serial(self):
-        db.execute("SELECT id, content FROM records WHERE type = 'SOA' and domain_id = %s", (self.zone_id,))
-        res = db.fetchone()
-        cur = res[1]
-        serial = int(cur.split()[2])+1
-        alt = int(datetime.now().strftime('%Y%m%d01'))
-        if alt > serial:
-            serial = alt
-        soa = "%s %s %s %s %s %s %s" % tuple(cur.split()[:2] + [serial] + cur.split()[3:])
-        db.execute("UPDATE records SET content = %s WHERE id = %s", (soa, res[0]))
 
-    def delete(self):
-        if not self.exists():
-            return
-        db.execute("DELETE from records where domain_id = %s", (self.zone_id,))
-        db.execute("DELETE from domains WHERE name = %s", (self.domain,))
+def sync_key(name, rtype, ttl, prio, content):
+    """Comparable form of a (name, type, ttl, prio, content) row for zone sync
 
-    def execute(self):
-        if self.to_delete:
-            self.delete()
-        else:
-            self.create()
+    Rows without ttl get DEFAULT_TTL like records added without one.
+    """
+    if ttl is None:
+        ttl = DEFAULT_TTL
+    if rtype in ZONE_NAME_TYPES or rtype in ['MX', 'SRV']:
+        content = content.rstrip('.')
+    if rtype not in ['MX', 'SRV']:
+        prio = None
+    return (name.lower(), rtype, ttl, None if prio is None else int(prio), content)
 
 
 class DNSCommander(cmd.Cmd):
@@ -293,11 +2973,102 @@ class DNSCommander(cmd.Cmd):
     todoqueue = []
     current_domain = None
     update_serial = False
+    zone_index = None
+    # Check records on commit with one query instead of on every command
+    defer_validation = False
+    # Set by run_batch, the whole batch is committed at the end
+    batch = False
+    # Set by apply_queue when zones were committed on their own
+    zones_committed = False
+    listener = None
+
+    def __init__(self, *args, **kwargs):
+        cmd.Cmd.__init__(self, *args, **kwargs)
+        self.domain_cache = {}
+        self.todoqueue = []
+
+    def precmd(self, line):
+        self.refresh_caches()
+        return line
+
+    def complete(self, text, state):
+        if state == 0:
+            self.refresh_caches()
+        return cmd.Cmd.complete(self, text, state)
+
+    def refresh_caches(self):
+        """Apply changes other sessions committed to cached zones and records
+
+        With listen_changes the listener is started once the session has
+        a database connection. Caches loaded before are dropped then.
+        """
+        if not LISTEN_CHANGES or backend().name != 'gpgsql':
+            return
+        try:
+            if self.listener is None:
+                if not dbconn.connected:
+                    return
+                self.listener = ChangeListener()
+                self.invalidate_caches()
+            for change in self.listener.poll(backend().session_pids()):
+                self.apply_notification(change)
+        except backend().errors as e:
+            print("Change listener failed: %s" % str(e).strip())
+            if self.listener is not None:
+                self.listener.close()
+            self.listener = None
+            self.invalidate_caches()
+
+    def invalidate_caches(self):
+        self.zone_index = None
+        for domain in self.domain_cache.values():
+            domain.clear_records()
+        self.domain_cache = dict([(k, v) for k, v in self.domain_cache.items() if v.zone_id is not None])
+
+    def apply_notification(self, change):
+        """Patch caches with a change sent by CHANGE_TRIGGERS"""
+        if change.get('table') == 'domains':
+            if change.get('removed') is None and change.get('added') is None:
+                return self.invalidate_caches()
+            for name in change.get('removed') or []:
+                domain = self.domain_cache.pop(name, None)
+                if domain is not None:
+                    domain.clear_records()
+                if self.zone_index is not None:
+                    self.zone_index.remove(name)
+            for name in change.get('added') or []:
+                # Lookups of a missing zone are cached with zone_id None
+                if name in self.domain_cache and self.domain_cache[name].zone_id is None:
+                    del self.domain_cache[name]
+                if self.zone_index is not None:
+                    self.zone_index.add(name)
+            return
+        zones = dict([(d.zone_id, d) for d in self.domain_cache.values() if d.zone_id is not None])
+        if change.get('removed') is None and change.get('added') is None:
+            if change.get('zones') is None:
+                return self.invalidate_caches()
+            for zone_id in change['zones']:
+                if zone_id in zones:
+                    zones[zone_id].clear_records()
+            return
+        for zone_id, name, rtype, ttl, prio, content in change.get('removed') or []:
+            if zone_id in zones and zones[zone_id]._records is not None:
+                zones[zone_id]._records.remove(name, rtype, content, ttl, prio)
+        for zone_id, name, rtype, ttl, prio, content in change.get('added') or []:
+            if zone_id in zones and zones[zone_id]._records is not None:
+                zones[zone_id]._records.add(RecordRow(name, rtype, ttl, prio, content))
+
+    def get_domain(self, name, zone_id=None):
+        """Domain object for name, shared for the session with its records"""
+        name = name.rstrip('.')
+        if name not in self.domain_cache:
+            self.domain_cache[name] = Domain(name, zone_id=zone_id)
+        return self.domain_cache[name]
 
     def do_domain(self, line):
         """Select and add new domain"""
         line = line.rstrip('.')
-        d = Domain(line)
+        d = self.get_domain(line)
         d.validate()
         if not d.exists():
             self.todoqueue.append(d)
@@ -305,81 +3076,71 @@ class DNSCommander(cmd.Cmd):
         self.current_domain = d
         self.prompt = '%s> ' % line
 
-    def complete_domain(self, line, text, begidx, endidx):
-        completions = []
-        db.execute("SELECT name from domains WHERE name LIKE %s", ('%s%%' % line.strip(),))
-        for res in db.fetchall():
-            if res[0].startswith(line.strip()):
-                completions.append(res[0])
-        if len(completions) > 20:
-            return []
-        return completions
+    def complete_domain(self, text, line, begidx, endidx):
+        # readline splits words also at '-', complete the whole argument
+        words = line[:endidx].split()
+        full_text = words[-1] if len(words) > 1 and not line[:endidx].endswith(' ') else ''
+        diff = len(full_text) - len(text)
+        return [x[diff:] for x in self.zones().complete(full_text.lower())]
+
+    def zones(self):
+        """Zone name index, loaded once per session and refreshed after cache_ttl
+
+        With a change listener it is kept up to date and does not expire.
+        """
+        if self.zone_index is None or \
+                (self.listener is None and time.time() - self.zone_index.loaded > CACHE_TTL):
+            self.zone_index = ZoneIndex(backend().zone_names())
+        return self.zone_index
+
+    def reverse_domain(self, reverse):
+        """Most specific zone for reverse name"""
+        zone = self.zones().longest_match(reverse)
+        if not zone:
+            raise CommandException("No such domain for %s" % reverse)
+        return self.get_domain(zone)
 
     def generate_reverse(self, ip, name, domain=None):
         name = name.rstrip('.') + '.'
-        if ':' in ip:
-            try:
-                ipobject = IPv6Address(ip)
-            except AddressValueError as e:
-                raise CommandException("Invalid IPv6 address: %s" % e)
-            reverse = '.'.join(ipobject.exploded[::-1].replace(':', '')) + '.ip6.arpa'
-        else:
-            try:
-                ipobject = IPv4Address(ip)
-            except AddressValueError as e:
-                raise CommandException("Invalid IPv4 address: %s" % e)
-            reverse = '.'.join(ipobject.exploded.split('.')[::-1]) + '.in-addr.arpa'
-        if not domain:
-             for d in self.get_domains():
-                if reverse.endswith(d[0]):
-                    domain = Domain(d[0])
-                    break
+        reverse = reverse_name(ip)
         if not domain:
-            raise CommandException("No such domain for %s" % reverse)
+            domain = self.reverse_domain(reverse)
 
-        for r in  domain.records():
-            if r['key'] == reverse:
-                raise CommandException("Reverse record for key %s already exists with value %s" % (reverse, r['value']))
+        for r in [] if self.defer_validation else domain.records().get(reverse):
+            raise CommandException("Reverse record for key %s already exists with value %s" % (reverse, r.value))
 
         if not reverse.endswith(domain.domain):
             raise CommandException("Wrong zone for this record!")
 
         reverse = reverse[:len(reverse) - len(domain.domain) - 1]
 
-        if domain.exists_record(reverse, "PTR", name):
+        if not self.defer_validation and domain.exists_record(reverse, "PTR", name):
             raise CommandException("Record already exists!")
 
         r = Record(reverse, "PTR", name, domain=domain)
+        r.reverse = self.defer_validation
         self.todoqueue.append(r)
         self.update_serial = True
 
     def delete_reverse(self, ip, name, domain=None):
         name = name.rstrip('.') + '.'
-        if ':' in ip:
-            try:
-                ipobject = IPv6Address(ip)
-            except AddressValueError as e:
-                raise CommandException("Invalid IPv6 address: %s" % e)
-            reverse = '.'.join(ipobject.exploded[::-1].replace(':', '')) + '.ip6.arpa'
-        else:
-            try:
-                ipobject = IPv4Address(ip)
-            except AddressValueError as e:
-                raise CommandException("Invalid IPv4 address: %s" % e)
-            reverse = '.'.join(ipobject.exploded.split('.')[::-1]) + '.in-addr.arpa'
+        reverse = reverse_name(ip)
         if not domain:
-             for d in self.get_domains():
-                if reverse.endswith(d[0]):
-                    domain = Domain(d[0])
-                    break
-        if not domain:
-            raise CommandException("No such domain for %s" % reverse)
+            domain = self.reverse_domain(reverse)
 
-        for r in  domain.records():
-            if r['key'] == reverse and r['value'].rstrip('.') == name.rstrip('.'):
+        if self.defer_validation:
+            r = Record(reverse[:len(reverse) - len(domain.domain) - 1], "PTR", name, domain=domain,
+                       action=RecordActions.DELETE)
+            r.optional = True
+            r.reverse = True
+            self.todoqueue.append(r)
+            self.update_serial = True
+            return
 
-                print("Removing reverse record %s PTR %s" % (r['key'], r['value']))
-                r = Record(reverse[:len(reverse) - len(domain.domain) - 1], "PTR", r['value'], ttl=r['ttl'], domain=domain, action=RecordActions.DELETE)
+        for r in domain.records().get(reverse, 'PTR'):
+            if r.value.rstrip('.') == name.rstrip('.'):
+                print("Removing reverse record %s PTR %s" % (r.key, r.value))
+                r = Record(reverse[:len(reverse) - len(domain.domain) - 1], "PTR", r.value, ttl=r.ttl, domain=domain, action=RecordActions.DELETE)
                 self.todoqueue.append(r)
                 self.update_serial = True
                 return
@@ -390,27 +3151,152 @@ class DNSCommander(cmd.Cmd):
         self.current_domain = None
         self.prompt = '> '
 
-    def do_commit(self, line):
-        """Commit changes"""
-        domains = []
-        for t in self.todoqueue:
-            t.execute()
-            if t.domain not in domains and isinstance(t.domain, Domain):
-                domains.append(t.domain)
+    def apply_queue(self, workers=None, per_zone=None):
+        """Execute queued tasks and bump serials without committing
+
+        Zones written to are locked first. On deadlocks and serialization
+        failures the transaction is rolled back and applied again up to
+        COMMIT_RETRIES times. With more than one worker a queue of record
+        changes is applied in parallel, see SqlBackend.apply_parallel.
+        Returns list of (task, success) and list of touched domains.
+        """
+        tasks = self.todoqueue
+        workers = workers or APPLY_WORKERS
+        if per_zone is None:
+            per_zone = APPLY_MODE == 'zone'
+        shards = shard_tasks(tasks) if workers > 1 and backend().parallel else None
+        if shards and len(shards) > 1 and not per_zone and backend().change_triggers():
+            print("Change triggers prevent two-phase commit, applying on one connection")
+            shards = None
+        self.zones_committed = bool(shards and len(shards) > 1 and per_zone)
+        attempt = 0
+        while True:
+            try:
+                if shards and len(shards) > 1:
+                    results = backend().apply_parallel(shards, workers, per_zone, self.update_serial)
+                else:
+                    backend().lock_zones(task_zone_ids(tasks))
+                    results = backend().apply(tasks)
+                domains = []
+                for t, success in results:
+                    for d in getattr(t, 'domains', None) or [t.domain]:
+                        if d not in domains and isinstance(d, Domain):
+                            domains.append(d)
+                if self.update_serial and not (shards and len(shards) > 1):
+                    backend().bump_serials(domains)
+                # errors of queued statements have to be retried too
+                backend().flush()
+                break
+            except backend().conflicts as e:
+                backend().rollback()
+                attempt += 1
+                if attempt > COMMIT_RETRIES:
+                    raise
+                stats.retries += 1
+                if DEBUG:
+                    print("Retrying commit after %s" % (str(e).strip(),))
+                time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
         self.todoqueue = []
-        if self.update_serial:
-            for d in domains:
-                d.inc_serial()
-        dbconn.commit()
+        return results, domains
+
+    def validate_queue(self):
+        """Validate queued records, drop optional ones that would fail
+
+        Returns list of (task, problem).
+        """
+        problems, skipped = validate_tasks(self.todoqueue)
+        if skipped:
+            skipped = set([id(t) for t in skipped])
+            self.todoqueue = [t for t in self.todoqueue if id(t) not in skipped]
+        return problems
+
+    def do_validate(self, line):
+        """
+        Check queued changes against the database:
+
+            validate [defer|immediate]
+
+        Adds of existing records, deletes of missing ones and repeated
+        changes are reported. With defer add and delete skip their own
+        checks and commit validates all queued records at once.
+        """
+        if line.strip() in ['defer', 'immediate']:
+            self.defer_validation = line.strip() == 'defer'
+            return
+        if line.strip():
+            raise CommandException("Invalid arguments")
+        problems = self.validate_queue()
+        for t, problem in problems:
+            print("%s: %s" % (VALIDATION_ERRORS[problem], t.show()))
+        print("%d changes, %d problems" % (len(self.todoqueue), len(problems)))
+
+    def do_commit(self, line):
+        """
+        Commit changes:
+
+            commit [--workers N] [--per-zone]
+
+        With more than one worker record changes are applied on N
+        connections in parallel, all or nothing with two-phase commit or
+        zone by zone with --per-zone. Defaults are apply_workers and
+        apply_mode in the config file.
+        """
+        args = line.split()
+        workers = pop_int_option(args, '--workers')
+        per_zone = True if '--per-zone' in args else None
+        if [x for x in args if x != '--per-zone']:
+            raise CommandException("Invalid arguments")
+        if self.defer_validation:
+            problems = self.validate_queue()
+            if problems:
+                for t, problem in problems:
+                    print("%s: %s" % (VALIDATION_ERRORS[problem], t.show()))
+                raise CommandException("%d problems, fix the queue or revert" % len(problems))
+        results, domains = self.apply_queue(workers, per_zone)
+        for t, success in results:
+            if not success:
+                print("Failed: %s" % t.show())
+        backend().commit()
+        self.committed(results)
         #self.reset_prompt()
         if self.update_serial:
-            for d in domains:
-                notify_domain(d.domain)
+            for result in NotifyDispatcher().notify([d.domain for d in domains]):
+                if DEBUG or not result.ok:
+                    print(result)
+
+    def committed(self, results):
+        """Bring session caches up to date with committed tasks"""
+        for t, success in results:
+            if not success:
+                continue
+            if isinstance(t, Record):
+                t.domain.apply_change(t)
+            elif isinstance(t, ZoneImport):
+                t.domain.clear_records()
+            elif isinstance(t, DeleteDomains):
+                for d in t.deleted:
+                    self.domain_cache.pop(d.domain, None)
+                    if self.zone_index is not None:
+                        self.zone_index.remove(d.domain)
+            elif isinstance(t, CreateDomains):
+                for d in t.domains:
+                    self.domain_cache[d.domain] = d
+                    if self.zone_index is not None:
+                        self.zone_index.add(d.domain)
+            elif isinstance(t, Domain):
+                if t.to_delete:
+                    self.domain_cache.pop(t.domain, None)
+                    if self.zone_index is not None:
+                        self.zone_index.remove(t.domain)
+                else:
+                    t.clear_records()
+                    if self.zone_index is not None:
+                        self.zone_index.add(t.domain)
 
     def do_revert(self, line):
         """Revert changes"""
         self.todoqueue = []
-        dbconn.rollback()
+        backend().rollback()
         #self.reset_prompt()
 
     def parse_ttl(self, ttl):
@@ -449,7 +3335,7 @@ class DNSCommander(cmd.Cmd):
             pass
         raise CommandException("Invalid port %s" % t)
 
-    def parse_record(self, line):
+    def parse_record(self, line, require_domain=True):
         ttl = None
         priority = None
         parts = line.split(None, 6)
@@ -459,24 +3345,29 @@ class DNSCommander(cmd.Cmd):
         record_type = parts[1].strip().upper()
         if record_type in ['TXT', 'A', 'AAAA', 'NS', 'CNAME', 'SPF']:
             parts = line.split(None, 3)
-            if len(parts) == 4:
+            if len(parts) == 4 and parts[2].startswith('"'):
+                # quoted value with spaces, no ttl
+                value = '%s %s' % (parts[2], parts[3])
+            elif len(parts) == 4:
                 ttl = self.parse_ttl(parts[2])
                 value = parts[3]
             elif len(parts) == 3:
                 value = parts[2]
             else:
                 raise CommandException("Cannot parse %s" % line)
-        if record_type in ['CAA']:
-            # CAA is a little special
+        elif record_type in ['CAA']:
+            # CAA is a little special, value has three fields itself
             parts = line.split(None, 3)
-            if len(parts) == 4:
+            if len(parts) == 4 and len(parts[3].split(None, 2)) < 3:
+                value = '%s %s' % (parts[2], parts[3])
+            elif len(parts) == 4:
                 ttl = self.parse_ttl(parts[2])
                 value = parts[3]
             elif len(parts) == 3:
                 value = parts[2]
             else:
                 raise CommandException("Cannot parse %s" % line)
-            if value.split(None, 2) != 3:
+            if len(value.split(None, 2)) != 3:
                 raise CommandException("Cannot parse %s, CAA record format flag type \"value\"" % line)
             caa_flag, caa_type, caa_value = value.split(None, 2)
             try:
@@ -512,18 +3403,9 @@ class DNSCommander(cmd.Cmd):
         else:
             raise CommandException("Cannot parse %s" % line)
 
-        if not self.current_domain:
+        if require_domain and not self.current_domain:
             raise CommandException("Select domain first!")
-        if record_type == "A":
-            try:
-                ipobject = IPv4Address(value)
-            except AddressValueError as e:
-                raise CommandException("Invalid IPv4 address: %s" % e)
-        if record_type == "AAAA":
-            try:
-                ipobject = IPv6Address(value)
-            except AddressValueError as e:
-                raise CommandException("Invalid IPv6 address: %s" % e)
+        check_content(record_type, value)
         return (key, record_type, value.lower(), ttl, priority)
 
     def do_add(self, line):
@@ -542,7 +3424,7 @@ class DNSCommander(cmd.Cmd):
         key = key.rstrip(".")
         if key.endswith(self.current_domain.domain):
             key = key[:-len(self.current_domain.domain)-1]
-        if self.current_domain.exists_record(key, record_type, value, priority=priority):
+        if not self.defer_validation and self.current_domain.exists_record(key, record_type, value, priority=priority):
             raise CommandException("Record already exists!")
 
         r = Record(key, record_type, value, ttl=ttl, priority=priority, domain=self.current_domain)
@@ -573,20 +3455,76 @@ class DNSCommander(cmd.Cmd):
         """
         Generate reverse records for name
             genrev name
+
+        For all A and AAAA records of current domain
+            genrev --all
+
+        For A and AAAA records of current domain in network, or with
+        template for every address of network. Template fields are {ip},
+        {dashed} (ip with - as separator) and {index} (offset in network)
+            genrev cidr [template]
         """
+        args = line.split()
+        if len(args) in [1, 2] and '/' in args[0]:
+            network = parse_network(args[0])
+            if len(args) == 2:
+                if network.num_addresses > MAX_GENREV:
+                    raise CommandException("Network %s is too large to fill, max %d addresses" % (network, MAX_GENREV))
+                template = args[1]
+                hosts = network.hosts() if network.num_addresses > 2 else iter(network)
+                try:
+                    pairs = [(str(ip), template.format(ip=ip, dashed=str(ip).replace('.', '-').replace(':', '-'),
+                                                       index=int(ip) - int(network.network_address)))
+                             for ip in hosts]
+                except (KeyError, IndexError, ValueError) as e:
+                    raise CommandException("Invalid template %s: %s" % (template, e))
+                self.generate_reverses(pairs)
+                return
+            if not self.current_domain:
+                raise CommandException("Select domain first")
+            self.generate_reverses([(x.value, x.key) for x in self.current_domain.records()
+                                    if x.type in ['A', 'AAAA'] and ip_in_network(x.value, network)])
+            return
         if not self.current_domain:
             raise CommandException("Select domain first")
         if not line:
             raise CommandException("Name required!")
-        for record in self.current_domain.records():
-            if record['key'] != line:
-                continue
-            if record['type'] in ['A', 'AAAA']:
+        if args == ['--all']:
+            self.generate_reverses([(x.value, x.key) for x in self.current_domain.records()
+                                    if x.type in ['A', 'AAAA']])
+            return
+        for record in self.current_domain.records().get(self.current_domain.fqdn(line)):
+            if record.type in ['A', 'AAAA']:
                 try:
-                    self.generate_reverse(record['value'], record['key'])
+                    self.generate_reverse(record.value, record.key)
                     self.update_serial = True
                 except CommandException as e:
-                    print("Not doing reverse for %s: %s" % (record['value'], e))
+                    print("Not doing reverse for %s: %s" % (record.value, e))
+
+    def generate_reverses(self, pairs):
+        """Queue reverse records for (ip, name) pairs, skipping ones that exist
+
+        Existing records are looked up in the loaded reverse zones, the
+        inserts go out batched on commit.
+        """
+        queued = 0
+        skipped = 0
+        seen = set()
+        for ip, name in pairs:
+            try:
+                reverse = reverse_name(ip)
+                if reverse in seen:
+                    raise CommandException("Reverse record for key %s already queued" % reverse)
+                self.generate_reverse(ip, name)
+                seen.add(reverse)
+                queued += 1
+            except CommandException as e:
+                skipped += 1
+                if skipped <= 10 or DEBUG:
+                    print("Not doing reverse for %s: %s" % (ip, e))
+        if skipped > 10 and not DEBUG:
+            print("... %d more skipped" % (skipped - 10))
+        print("Generating %d reverse records, %d skipped" % (queued, skipped))
 
     def do_delete(self, line):
         """Delete dns record:
@@ -602,7 +3540,9 @@ class DNSCommander(cmd.Cmd):
             key = key[:-len(self.current_domain.domain)-1].strip()
         if key == '':
             key = '@'
-        if not self.current_domain.exists_record(key, record_type, value, priority=priority):
+        if self.defer_validation:
+            pass
+        elif not self.current_domain.exists_record(key, record_type, value, priority=priority):
             print("key: '%s' type: '%s' value: '%s' priority: '%s'" % (key, record_type, value, priority))
             if not self.current_domain.exists_record(key, record_type, "%s %s" % (priority, value), priority=None):
                 raise CommandException("Record does not exists!")
@@ -635,21 +3575,21 @@ class DNSCommander(cmd.Cmd):
             raise CommandException("Removing all from root level is not allowed.")
 
         for row in self.current_domain.get_records(key=key, rtype=type):
-            if row["type"].upper() in ["SOA"]:
+            if row.type.upper() in ["SOA"]:
                 print("Skipping SOA record")
                 continue
-            row_key = row['key']
+            row_key = row.key
             if row_key.endswith(self.current_domain.domain):
                 row_key = row_key[:-len(self.current_domain.domain) - 1].strip()
-            r = Record(row_key, row["type"], row["value"], ttl=row["ttl"], priority=None if row["priority"] == '-' else row["priority"],
+            r = Record(row_key, row.type, row.value, ttl=row.ttl, priority=row.priority,
                        domain=self.current_domain, action=RecordActions.DELETE)
             self.todoqueue.append(r)
-            if row["type"] in ['A', 'AAAA']:
-                if self.current_domain.domain not in row["key"]:
-                    rev_key = '%s.%s' % (row["key"], self.current_domain.domain)
+            if row.type in ['A', 'AAAA']:
+                if self.current_domain.domain not in row.key:
+                    rev_key = '%s.%s' % (row.key, self.current_domain.domain)
                 else:
-                    rev_key = row["key"]
-                self.delete_reverse(row["value"], rev_key)
+                    rev_key = row.key
+                self.delete_reverse(row.value, rev_key)
         self.update_serial = True
 
     def complete_delete(self, text, line, beginidx, endidx):
@@ -663,19 +3603,13 @@ class DNSCommander(cmd.Cmd):
             diff = len(full_text) - len(text)
             if full_text == '@':
                 return [self.current_domain.domain]
-            record_set = [y['key'][diff:] for y in records if y['key'].startswith(full_text)]
-            # Make list unique
-            return list(set(record_set))
+            return [x[diff:] for x in records.names_with_prefix(full_text)]
         elif l == 2 or (l == 3 and text):
             key = line.split()[1].strip()
-            #print("B: %s" % key)
             types = []
-            for y in records:
-                #print("%s %s %s" % (y['key'], y['key'] == key, key))
-                if y['key'] == key:
-                    #print("%s type: %s value: %s" % (y['key'], y['type'], y['value']))
-                    if y['type'] not in types:
-                        types.append(y['type'])
+            for y in records.get(key):
+                if y.type not in types:
+                    types.append(y.type)
             return [x for x in types if x.startswith(text)]
         elif l == 3 or (l == 4 and text):
             key, key_type = line.split()[1:3]
@@ -684,9 +3618,250 @@ class DNSCommander(cmd.Cmd):
             else:
                 full_text = text
             diff = len(full_text) - len(text)
-            return list(set([x['value'][diff:] for x in records if x['key'] == key and x['type'] == key_type and x['value'].startswith(text)]))
+            return list(set([x.value[diff:] for x in records.get(key, key_type) if x.value.startswith(text)]))
         return []
 
+    def do_import(self, line):
+        """
+        Import records from zone file to current domain:
+
+            import file
+
+        Without domain context the zone name is required, --create adds
+        the domain if it does not exist:
+
+            import file zone [--create]
+
+        The file is validated now and loaded on commit.
+        """
+        if backend().name != 'gpgsql':
+            raise CommandException("import requires the gpgsql backend")
+        args = line.split()
+        create = '--create' in args
+        args = [x for x in args if x != '--create']
+        if len(args) == 1 and self.current_domain:
+            domain = self.current_domain
+        elif len(args) == 2:
+            domain = self.get_domain(args[1])
+            domain.validate()
+            if not domain.exists() and domain not in self.todoqueue:
+                if not create:
+                    raise CommandException("Domain %s does not exist, use --create" % domain.domain)
+                self.todoqueue.append(domain)
+        else:
+            raise CommandException("Invalid arguments")
+        task = ZoneImport(args[0], domain)
+        task.validate()
+        self.todoqueue.append(task)
+        self.update_serial = True
+        print(task.show())
+
+    def do_sync(self, line):
+        """
+        Make zones match the records in a JSON or YAML file or directory:
+
+            sync path [zone] [--create] [--commit]
+
+        File maps zone names to lists of records, directory has one file
+        per zone named like example.com.json. Records are objects with
+        name, type, content and optional ttl and prio. Without zone all
+        zones in path are synced, in domain context the current zone.
+        Minimal deletes and adds are queued, --commit commits each zone
+        after it is compared instead. --commit needs an empty queue and is
+        not available in batch mode.
+        """
+        args = line.split()
+        create = '--create' in args
+        commit = '--commit' in args
+        args = [x for x in args if x not in ['--create', '--commit']]
+        if len(args) not in [1, 2]:
+            raise CommandException("Invalid arguments")
+        if commit and self.batch:
+            raise CommandException("sync --commit is not available in batch mode")
+        if commit and self.todoqueue:
+            print("Commit or revert first")
+            return False
+        zone = args[1].rstrip('.') if len(args) == 2 else None
+        if zone is None and self.current_domain:
+            zone = self.current_domain.domain
+        for name, records in iter_desired_zones(args[0], zone):
+            added, deleted = self.sync_zone(name, records, create)
+            print("sync %s: %d to add, %d to delete" % (name, added, deleted))
+            if commit and self.todoqueue:
+                self.do_commit('')
+
+    def sync_zone(self, name, records, create=False):
+        """Queue changes making zone contain exactly records, SOA excepted"""
+        domain = self.get_domain(name)
+        domain.validate()
+        if domain.exists():
+            current = {}
+            for row in domain.iter_rows():
+                if row[1] != 'SOA':
+                    current[sync_key(*row)] = row
+        elif create:
+            if domain not in self.todoqueue:
+                self.todoqueue.append(domain)
+            # Domain.create adds the default name servers
+            current = dict([(sync_key(domain.domain, 'NS', DEFAULT_TTL, None, x), (domain.domain, 'NS', DEFAULT_TTL, None, x))
+                            for x in [MASTER_DNS] + SLAVES])
+        else:
+            raise CommandException("Domain %s does not exist, use --create" % name)
+
+        desired = {}
+        for record in records or []:
+            try:
+                row = (domain.fqdn(record['name']), record['type'].upper(), int(record.get('ttl') or DEFAULT_TTL),
+                       record.get('prio', record.get('priority')), '%s' % record['content'])
+            except (KeyError, TypeError, ValueError, AttributeError):
+                raise CommandException("Invalid record %s in zone %s" % (record, name))
+            if row[1] != 'SOA':
+                desired[sync_key(*row)] = row
+
+        def relative(key):
+            if key == domain.domain:
+                return '@'
+            return key[:-len(domain.domain) - 1]
+
+        deleted = [current[x] for x in current if x not in desired]
+        added = [desired[x] for x in desired if x not in current]
+        for key, rtype, ttl, prio, content in deleted:
+            self.todoqueue.append(Record(relative(key), rtype, content, ttl=ttl, domain=domain,
+                                         priority=prio if rtype in ['MX', 'SRV'] else None,
+                                         action=RecordActions.DELETE))
+        for key, rtype, ttl, prio, content in added:
+            self.todoqueue.append(Record(relative(key), rtype, content, ttl=ttl, priority=prio, domain=domain))
+        if added or deleted:
+            self.update_serial = True
+        return len(added), len(deleted)
+
+    def load_template(self, name=None):
+        """DomainTemplate from a JSON or YAML file or a [template:name] config section
+
+        Records are given as add command arguments, in files also as
+        objects with name, type, content and optional ttl and prio.
+        """
+        if name and os.path.isfile(name):
+            data = load_records_file(name)
+            if not isinstance(data, dict):
+                raise CommandException("Template %s is not a mapping" % name)
+        elif config.has_section('template:%s' % (name or 'default')):
+            data = dict(config.items('template:%s' % (name or 'default')))
+            data['records'] = [x.strip() for x in data.get('records', '').splitlines() if x.strip()]
+        elif name:
+            raise CommandException("No template %s" % name)
+        else:
+            return DomainTemplate()
+
+        nameservers = data.get('nameservers')
+        if isinstance(nameservers, str):
+            nameservers = [x.strip() for x in nameservers.split(',') if x.strip()]
+        records = []
+        for record in data.get('records') or []:
+            if isinstance(record, dict):
+                try:
+                    records.append((record['name'], record['type'].upper(), record.get('ttl'),
+                                    record.get('prio', record.get('priority')), '%s' % record['content']))
+                except (KeyError, AttributeError):
+                    raise CommandException("Invalid record %s in template %s" % (record, name))
+            else:
+                key, rtype, value, ttl, prio = self.parse_record(record, require_domain=False)
+                records.append((key, rtype, ttl, prio, value))
+        try:
+            ttl = int(data['ttl']) if data.get('ttl') else None
+        except ValueError:
+            raise CommandException("Invalid ttl in template %s" % name)
+        return DomainTemplate(name or 'default', data.get('soa'), nameservers, ttl, records)
+
+    def do_createdomains(self, line):
+        """
+        Create many domains from a template:
+
+            createdomains [--template name|file] [--file names] [domain ...]
+
+        Domains are read from the arguments and from a file with one name
+        per line. The template is a [template:name] section in the config
+        file or a JSON or YAML file with soa, nameservers, ttl and records,
+        [template:default] or the built-in defaults are used without it.
+        All domains and records are inserted with one INSERT and one COPY
+        on commit.
+        """
+        args = line.split()
+        template = self.load_template(pop_option(args, '--template'))
+        names_file = pop_option(args, '--file')
+        if names_file:
+            try:
+                with open(names_file, 'r') as f:
+                    args += [x.split('#', 1)[0].strip() for x in f]
+            except (IOError, OSError) as e:
+                raise CommandException("Cannot read %s: %s" % (names_file, e))
+        names = list(OrderedDict.fromkeys([x.rstrip('.').lower() for x in args if x]))
+        if not names:
+            raise CommandException("No domains given")
+        for name in names:
+            if ' ' in name or '.' not in name:
+                raise CommandException("Invalid domain %s" % name)
+        queued = set()
+        for t in self.todoqueue:
+            if isinstance(t, Domain):
+                queued.add(t.domain)
+            elif isinstance(t, CreateDomains):
+                queued.update(t.names)
+        existing = sorted(set(backend().zone_ids(names)) | (queued & set(names)))
+        if existing:
+            raise CommandException("Domains already exist: %s" % ', '.join(existing[:10]))
+        self.todoqueue.append(CreateDomains(names, template))
+        self.update_serial = True
+        print("Queued %d domains from template %s" % (len(names), template.name))
+
+    def do_deletedomains(self, line):
+        """
+        Delete many domains and reverse records pointing to them:
+
+            deletedomains [--file names] domain|pattern ...
+
+        Patterns may use * and ?, for example *.customer.example. PTR
+        records in other zones pointing to names in the deleted domains
+        are deleted too and those zones get one serial bump each.
+        """
+        args = line.split()
+        names_file = pop_option(args, '--file')
+        if names_file:
+            try:
+                with open(names_file, 'r') as f:
+                    args += [x.split('#', 1)[0].strip() for x in f]
+            except (IOError, OSError) as e:
+                raise CommandException("Cannot read %s: %s" % (names_file, e))
+        args = [x.rstrip('.').lower() for x in args if x]
+        if not args:
+            raise CommandException("No domains given")
+        names = [x for x in args if '*' not in x and '?' not in x]
+        zones = backend().zone_ids(names) if names else {}
+        missing = [x for x in names if x not in zones]
+        if missing:
+            raise CommandException("No such domains: %s" % ', '.join(missing[:10]))
+        patterns = [x for x in args if x not in names]
+        if patterns:
+            zones.update(backend().match_zones(patterns))
+        if not zones:
+            raise CommandException("No domains match %s" % ' '.join(patterns))
+        if self.current_domain and self.current_domain.domain in zones:
+            raise CommandException("Get out of domain context %s first" % self.current_domain.domain)
+        for t in self.todoqueue:
+            if isinstance(getattr(t, 'domain', None), Domain) and t.domain.domain in zones:
+                raise CommandException("Changes to %s queued, commit or revert first" % t.domain.domain)
+
+        domains = [self.get_domain(name, zone_id) for name, zone_id in sorted(zones.items())]
+        ptrs = 0
+        for zone, zone_id, name, ttl, content in backend().dangling_ptrs(list(zones.values())):
+            reverse = self.get_domain(zone, zone_id)
+            self.todoqueue.append(Record(name[:len(name) - len(zone) - 1], 'PTR', content, ttl=ttl,
+                                         domain=reverse, action=RecordActions.DELETE))
+            ptrs += 1
+        self.todoqueue.append(DeleteDomains(domains))
+        self.update_serial = True
+        print("Queued delete of %d domains and %d reverse records" % (len(domains), ptrs))
+
     def do_deletedomain(self, line):
         if self.current_domain:
             print("Get out of domain context first")
@@ -717,10 +3892,44 @@ class DNSCommander(cmd.Cmd):
             return True
 
     def onecmd(self, str):
+        stats.begin(self.parseline(str)[0] or str)
         try:
             return cmd.Cmd.onecmd(self, str)
         except CommandException as e:
             print('Error: %s' % e)
+        finally:
+            if self.parseline(str)[0] != 'stats':
+                stats.end()
+
+    def do_stats(self, line):
+        """
+        Show backend statistics of this session:
+
+            stats [reset]
+
+        Statements are listed by total time with call count, mean, 95th
+        percentile bucket, max and rows. Commands show round trips.
+        """
+        if line.strip() == 'reset':
+            stats.reset()
+            return
+        if line.strip():
+            raise CommandException("Invalid arguments")
+        if stats.last:
+            command, (trips, seconds, rows) = stats.last
+            print("Last command %s: %d round trips, %.1f ms, %d rows" % (command, trips, seconds * 1000, rows))
+        if stats.retries:
+            print("Commits retried after conflicts: %d" % stats.retries)
+        print("%-12s %6s %8s %10s" % ('command', 'count', 'trips', 'ms'))
+        for name, e in sorted(stats.commands.items(), key=lambda x: -x[1]['seconds']):
+            print("%-12s %6d %8d %10.1f" % (name, e['count'], e['round_trips'], e['seconds'] * 1000))
+        print("")
+        print("%6s %10s %8s %8s %8s %8s  %s" % ('count', 'total ms', 'mean', 'p95 <=', 'max', 'rows', 'statement'))
+        for table in (stats.statements, dict([('NOTIFY ' + k, v) for k, v in stats.notifies.items()])):
+            for key, e in sorted(table.items(), key=lambda x: -x[1]['seconds']):
+                print("%6d %10.1f %8.1f %8.1f %8.1f %8d  %s" % (
+                    e['count'], e['seconds'] * 1000, e['seconds'] * 1000 / e['count'],
+                    stats.percentile(e, 0.95) * 1000, e['max'] * 1000, e['rows'], key[:120]))
 
 
     def do_show(self, line):
@@ -733,33 +3942,181 @@ class DNSCommander(cmd.Cmd):
             print(thing.show())
 
     def do_list(self, line):
-        """list [filter]
+        """list [--limit N] [--offset N] [filter]
         List Domains/records
         """
-        keys = ["key", "type", "value"]
-        if line:
-            keywords = line.strip().split()
-        else:
-            keywords = []
+        keywords = line.strip().split()
+        limit = pop_int_option(keywords, '--limit')
+        offset = pop_int_option(keywords, '--offset') or 0
         if self.current_domain:
             print("\033[1m{0:<40} {1:<6} {2:<5} {3:>4} {4}\033[0m".format("key", "ttl", "type", "priority", "value"))
-            for row in self.current_domain.records():
-                if keywords:
-                    found = False
-                    for x in keys:
-                        for k in keywords:
-                            if k in row[x]:
-                                found = True
-                                continue
-                    if not found:
-                        continue
-                print("{key:<40} {ttl:<6} {type:<5} {priority:>4} {value}".format(**row))
+            for row in self.current_domain.iter_rows(keywords, limit, offset):
+                print("{key:<40} {ttl:<6} {type:<5} {priority:>4} {value}".format(**self.current_domain._format_record(row)))
         else:
             print("\033[1m{0:<40} {1:<10} {2:>12}\033[0m".format("name", "type", "notified serial"))
-            for row in self.get_domains():
+            for row in islice(self.iter_domains(), offset, None if limit is None else offset + limit):
                 print("{0:<40} {1:<10} {2:>12}".format(*row))
         print("")
 
+    def do_find(self, line):
+        """
+        Find records in all zones:
+
+            find [--type T] [--name N] [--content C] [--regex RE] [--zone Z] [--limit N] [text ...]
+
+        name and content match exactly, text as substring of name, type or
+        content and regex (PostgreSQL syntax) name or content. Run
+        createindexes once to make these fast on large databases.
+        """
+        if backend().name != 'gpgsql':
+            raise CommandException("find requires the gpgsql backend")
+        args = line.split()
+        rtype = pop_option(args, '--type')
+        zone = pop_option(args, '--zone')
+        filters = {
+            'rtype': rtype.upper() if rtype else None,
+            'name': pop_option(args, '--name'),
+            'content': pop_option(args, '--content'),
+            'regex': pop_option(args, '--regex'),
+            'limit': pop_int_option(args, '--limit'),
+            'keywords': args,
+        }
+        if filters['name']:
+            filters['name'] = filters['name'].rstrip('.').lower()
+        if zone:
+            domain = self.get_domain(zone)
+            if not domain.exists():
+                raise CommandException("Domain %s does not exist" % zone)
+            filters['zone_id'] = domain.zone_id
+        if not [x for x in filters.values() if x]:
+            raise CommandException("Give at least one filter")
+        print("\033[1m{0:<30} {1:<40} {2:<6} {3:<5} {4:>4} {5}\033[0m".format("zone", "key", "ttl", "type", "priority", "value"))
+        try:
+            for row in backend().search_records(**filters):
+                print("{0:<30} {1:<40} {2:<6} {3:<5} {4:>4} {5}".format(*[x if x is not None else '-' for x in row]))
+        except backend().errors as e:
+            # Nothing is written before commit, the failed read can be rolled back
+            backend().rollback()
+            raise CommandException("Search failed: %s" % str(e).strip())
+        print("")
+
+    def do_audit(self, line):
+        """
+        Check forward and reverse records of all zones:
+
+            audit [--fix]
+
+        Reports A/AAAA records without PTR in an existing reverse zone
+        (missing), PTRs to local zones whose address has no A/AAAA record
+        (dangling) and PTRs pointing to another name than the records of
+        their address (mismatched). With --fix missing PTRs are added,
+        dangling ones deleted and mismatched ones pointed to the first
+        name of the address. Review the changes with show and commit.
+        """
+        if backend().name != 'gpgsql':
+            raise CommandException("audit requires the gpgsql backend")
+        args = line.split()
+        fix = '--fix' in args
+        if [x for x in args if x != '--fix']:
+            raise CommandException("Invalid arguments")
+        zones = self.zones()
+        counts = OrderedDict([('missing', 0), ('dangling', 0), ('mismatched', 0)])
+        added = set()
+        queued = len(self.todoqueue)
+
+        def ptr(reverse, target, action, ttl=None, zone=None, zone_id=None):
+            # deletes go to the zone the PTR is stored in
+            if zone is None:
+                zone = zones.longest_match(reverse)
+            key = '@' if reverse == zone else reverse[:-len(zone) - 1]
+            self.todoqueue.append(Record(key, 'PTR', target, domain=self.get_domain(zone, zone_id), ttl=ttl, action=action))
+
+        try:
+            for problem, ip, names, record, covered in backend().audit_reverses():
+                if problem == 'missing':
+                    if not zones.longest_match(reverse_name(ip)):
+                        continue
+                    print("missing     %-39s %s" % (ip, ', '.join(names)))
+                elif problem == 'dangling':
+                    if not zones.longest_match(record[4].rstrip('.').lower()):
+                        continue
+                    print("dangling    %-39s %s PTR %s" % (ip, record[2], record[4]))
+                else:
+                    print("mismatched  %-39s %s PTR %s, address of %s" % (ip, record[2], record[4], ', '.join(names)))
+                counts[problem] += 1
+                if not fix:
+                    continue
+                if problem != 'missing':
+                    ptr(record[2], record[4], RecordActions.DELETE, ttl=record[3], zone=record[1], zone_id=record[0])
+                if names and not covered and ip not in added:
+                    ptr(reverse_name(ip), names[0] + '.', RecordActions.ADD)
+                    added.add(ip)
+        except backend().errors as e:
+            backend().rollback()
+            raise CommandException("Audit failed: %s" % str(e).strip())
+        print(', '.join(["%d %s" % (n, problem) for problem, n in counts.items()]))
+        if fix and len(self.todoqueue) > queued:
+            self.update_serial = True
+            print("Queued %d changes" % (len(self.todoqueue) - queued))
+
+    def do_installtriggers(self, line):
+        """
+        Create triggers on domains and records notifying sessions with
+        listen_changes about committed changes (PostgreSQL 10 or newer).
+        Atomic commit --workers uses one connection with the triggers.
+        """
+        if backend().name != 'gpgsql':
+            raise CommandException("installtriggers requires the gpgsql backend")
+        if self.todoqueue:
+            print("Commit or revert first")
+            return False
+        for statement in backend().install_triggers():
+            print(statement.split('\n')[0])
+
+    def do_createindexes(self, line):
+        """
+        Create database indexes for find and list filters (pg_trgm and
+        hash index on record content)
+        """
+        if backend().name != 'gpgsql':
+            raise CommandException("createindexes requires the gpgsql backend")
+        if self.todoqueue:
+            print("Commit or revert first")
+            return False
+        for statement in backend().create_indexes():
+            print(statement)
+
+    def do_export(self, line):
+        """
+        Export current domain as BIND zone file or JSON lines:
+
+            export [bind|json] [file]
+
+        Records are streamed from the database, output goes to stdout
+        when file is not given.
+        """
+        if not self.current_domain:
+            raise CommandException("Select domain first")
+        args = line.split()
+        export_format = 'bind'
+        if args and args[0] in ['bind', 'json']:
+            export_format = args.pop(0)
+        if len(args) > 1:
+            raise CommandException("Invalid arguments")
+        out = open(args[0], 'w') if args else sys.stdout
+        try:
+            domain = self.current_domain.domain
+            if export_format == 'bind':
+                out.write("$ORIGIN %s.\n" % domain)
+            for row in self.current_domain.iter_rows():
+                if export_format == 'bind':
+                    out.write(bind_line(domain, row) + "\n")
+                else:
+                    out.write(json.dumps(dict(zip(['name', 'type', 'ttl', 'prio', 'content'], row))) + "\n")
+        finally:
+            if args:
+                out.close()
+
     def do_ls(self, line):
         return self.do_list(line)
 
@@ -767,9 +4124,122 @@ class DNSCommander(cmd.Cmd):
         global DEBUG
         DEBUG = not DEBUG
 
+    def iter_domains(self):
+        for a, b, c in backend().iter_domains():
+            yield [a, b, '%s' % c]
+
     def get_domains(self):
-        db.execute("SELECT name, type, notified_serial FROM domains ORDER BY name")
-        return [[a, b, '%s' % c] for a,b,c in db.fetchall()]
+        return list(self.iter_domains())
+
+BATCH_COMMANDS = ['domain', 'add', 'delete', 'deleteall', 'addrev', 'genrev', 'import', 'sync', 'createdomains',
+                  'deletedomains', 'audit']
+
+
+def run_batch(stream, out=sys.stdout, metrics_file=None, defer_validation=False, workers=None, per_zone=None):
+    """Apply command script from stream in one transaction
+
+    Every line is parsed and validated before anything is written. Prints
+    a JSON result to out and returns the exit status: 0 on success, 1 if
+    any line or record failed and 2 on database errors. Query statistics
+    are written to metrics_file in Prometheus text format if given. With
+    defer_validation records are checked with a few queries after all
+    lines are read instead of line by line. workers and per_zone are
+    passed to apply_queue, zones committed on their own stay committed
+    when others fail and are reported in zones and notified.
+    """
+    start = time.time()
+    commander = DNSCommander()
+    commander.defer_validation = defer_validation
+    commander.batch = True
+    origins = {}
+    result = {'status': 'ok', 'lines': 0, 'changes': 0, 'errors': [], 'failed': [], 'zones': [], 'notify': []}
+    # Command chatter goes to stderr, stdout is reserved for the result
+    with redirect_stdout(sys.stderr):
+        try:
+            for lineno, line in enumerate(stream, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                result['lines'] += 1
+                command, _, args = line.partition(' ')
+                queued = len(commander.todoqueue)
+                try:
+                    if command not in BATCH_COMMANDS:
+                        raise CommandException("Unknown command %s" % command)
+                    getattr(commander, 'do_' + command)(args.strip())
+                except CommandException as e:
+                    result['errors'].append({'line': lineno, 'command': line, 'error': str(e)})
+                for t in commander.todoqueue[queued:]:
+                    origins.setdefault(id(t), (lineno, line))
+            if defer_validation and not result['errors']:
+                lineno, line = None, None
+                for t, problem in commander.validate_queue():
+                    lineno, line = origins[id(t)]
+                    result['errors'].append({'line': lineno, 'command': line,
+                                             'error': "%s: %s" % (VALIDATION_ERRORS[problem], t.show())})
+        except backend().errors as e:
+            result['status'] = 'error'
+            result['errors'].append({'line': lineno, 'command': line, 'error': str(e).strip()})
+        result['changes'] = len(commander.todoqueue)
+
+        if not result['errors'] and commander.todoqueue:
+            try:
+                results, domains = commander.apply_queue(workers, per_zone)
+                result['failed'] = [t.show() for t, success in results if not success]
+                if result['failed']:
+                    backend().rollback()
+                    # zones committed on their own stay, report and notify them
+                    domains = [] if not commander.zones_committed else \
+                        list(OrderedDict.fromkeys([t.domain for t, success in results if success]))
+                else:
+                    backend().commit()
+                result['zones'] = [d.domain for d in domains]
+                if result['zones'] and commander.update_serial:
+                    result['notify'] = [x.as_dict() for x in NotifyDispatcher().notify(result['zones'])]
+            except CommandException as e:
+                # input that changed since it was validated, like an imported file
+                backend().rollback()
+                result['errors'].append({'error': str(e)})
+            except backend().errors as e:
+                backend().rollback()
+                result['status'] = 'error'
+                result['errors'].append({'error': str(e).strip()})
+
+    status = 0
+    if result['status'] == 'error':
+        status = 2
+    elif result['errors'] or result['failed']:
+        result['status'] = 'failed'
+        status = 1
+    out.write(json.dumps(result) + "\n")
+    if metrics_file:
+        stats.write_prometheus(metrics_file, [
+            ('pdnscmd_batch_duration_seconds', '%f' % (time.time() - start)),
+            ('pdnscmd_batch_changes', result['changes']),
+            ('pdnscmd_batch_exit_status', status),
+            ('pdnscmd_batch_last_run_timestamp_seconds', int(time.time())),
+        ])
+    return status
+
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Manage PowerDNS domains and records")
+    parser.add_argument('-b', '--batch', metavar='FILE',
+                        help="apply commands from FILE ('-' for stdin) in one transaction and exit")
+    parser.add_argument('--metrics-file', metavar='FILE',
+                        help="write batch query statistics to FILE in Prometheus text format")
+    parser.add_argument('--defer-validation', action='store_true',
+                        help="check all batch records at once after reading the input")
+    parser.add_argument('--workers', type=int, metavar='N',
+                        help="apply batch record changes on N connections in parallel")
+    parser.add_argument('--per-zone', action='store_true', default=None,
+                        help="commit every zone on its own when applying in parallel")
+    options = parser.parse_args()
+    if options.batch:
+        kwargs = {'metrics_file': options.metrics_file, 'defer_validation': options.defer_validation,
+                  'workers': options.workers, 'per_zone': options.per_zone}
+        if options.batch == '-':
+            sys.exit(run_batch(sys.stdin, **kwargs))
+        with open(options.batch, 'r') as f:
+            sys.exit(run_batch(f, **kwargs))
     DNSCommander().cmdloop()